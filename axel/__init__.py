@@ -7,6 +7,10 @@
 
 import inspect
 from .axel import *
+try:
+    from .aio import AsyncEvent
+except (ImportError, SyntaxError):  #asyncio requires Python 3
+    pass
 __all__ = sorted(name for name, obj in locals().items()
                  if not (name.startswith('_') or inspect.ismodule(obj))) 
 __all__.append('axel')
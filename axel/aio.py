@@ -0,0 +1,166 @@
+# aio.py
+#
+# This module is part of Axel and is released under
+# the MIT License: http://www.opensource.org/licenses/mit-license.php 
+#
+# Requires Python 3, it is skipped by the axel package on Python 2.
+
+import sys, time, asyncio, functools, inspect
+from .axel import Event, HandlerTimeout, _MISSING
+
+class AsyncEvent(Event):
+    """
+    Event dispatched on an asyncio event loop instead of threads. Handlers 
+    can be coroutine functions or plain callables, fire is a coroutine and 
+    returns the same execution result as Event.fire.
+    
+    from axel import AsyncEvent
+    
+    event = AsyncEvent()
+    async def on_event(*args, **kwargs):
+        await asyncio.sleep(0.1)
+        return (args, kwargs)
+    
+    event += on_event
+    print(await event(10, 20, y=30))
+    >> ((True, ((10, 20), {'y': 30}), <function on_event at 0x7f...>),)
+    
+    Handlers registered with a timeout are awaited through asyncio.wait_for
+    and fail with HandlerTimeout once it expires. Plain handlers having a 
+    timeout run in the loop's default executor so they can be abandoned; 
+    all other plain handlers run on the loop. Statistics and hooks work 
+    as for Event.
+    """
+    
+    def __init__(self, sender=None, asynch=False, exc_info=False, 
+                 lock=None, threads=3, traceback=False, cache_size=128, 
+                 cache_ttl=None, weak=False, stats=False):
+        """ Creates an event, see Event.__init__ 
+        
+        asynch
+            if True, fire schedules the handlers as tasks and returns 
+            without waiting for them
+        lock
+            asyncio.Lock used to synchronize execution
+        threads
+            maximum number of handlers executing concurrently per fire
+        """
+        super(AsyncEvent, self).__init__(sender, asynch, exc_info, lock, 
+                                         threads, traceback, 
+                                         cache_size=cache_size, 
+                                         cache_ttl=cache_ttl, weak=weak, 
+                                         stats=stats)
+        self.tasks = set()
+        
+    async def fire(self, *args, **kwargs):
+        """ Executes the registered handlers on the running loop """
+        handlers = [h for k, h in self._resolve()]
+        if not handlers:
+            return None
+        
+        queued = None
+        if self.profiler is not None:
+            queued = self.profiler.fired()
+            
+        limit = None
+        if self.threads < len(handlers):
+            limit = asyncio.Semaphore(self.threads)
+            
+        calls = [self._call_async(limit, handler, memoize, timeout, 
+                                  args, kwargs, queued) 
+                 for handler, memoize, timeout in handlers]
+        
+        if self.asynchronous:
+            for call in calls:
+                task = asyncio.ensure_future(call)
+                self.tasks.add(task)    #keep a reference until done
+                task.add_done_callback(self.tasks.discard)
+            return tuple((None, None, handler) for handler, m, t in handlers)
+        
+        if len(calls) == 1:
+            return (await calls[0],)
+        return tuple(await asyncio.gather(*calls))
+    
+    async def _call_async(self, limit, handler, memoize, timeout, args, 
+                          kwargs, queued=None):
+        """ Executes a single handler and returns its execution result, 
+        going through the profiler if statistics or hooks are enabled """
+        if limit is not None:
+            async with limit:
+                return await self._call_async(None, handler, memoize, 
+                                              timeout, args, kwargs, queued)
+        
+        profiler = self.profiler
+        if profiler is None:
+            result, hit = await self._locked_async(memoize, timeout, 
+                                                   handler, args, kwargs)
+            return result
+        
+        profiler.before(self, handler, args, kwargs)
+        start = time.time()
+        result, hit = await self._locked_async(memoize, timeout, handler, 
+                                               args, kwargs)
+        profiler.after(self, handler, result, start, queued, hit)
+        return result
+    
+    async def _locked_async(self, memoize, timeout, handler, args, kwargs):
+        """ Executes a single handler, synchronized by self.lock """
+        if isinstance(self.lock, asyncio.Lock):
+            async with self.lock:
+                return await self._memoize_async(memoize, timeout, handler, 
+                                                 args, kwargs)
+        return await self._memoize_async(memoize, timeout, handler, 
+                                         args, kwargs)
+    
+    async def _memoize_async(self, memoize, timeout, handler, args, kwargs):
+        """ Asynchronous counterpart of Event._memoize, returns the 
+        execution result and whether it came from the cache """
+        if not isinstance(handler, Event) and self.sender is not None:
+            args = (self.sender,) + tuple(args)
+            
+        try:
+            if memoize:
+                hash_ = hash(handler)
+                result = self.memoize.get(hash_, args, kwargs)
+                if result is not _MISSING:
+                    return (True, result, handler), True
+                
+            result = await self._invoke_async(timeout, handler, args, kwargs)
+            
+            if memoize:
+                self.memoize.put(hash_, args, kwargs, result)
+            return (True, result, handler), False
+        except Exception:
+            return (False, self._error(sys.exc_info()), handler), False
+    
+    async def _invoke_async(self, timeout, handler, args, kwargs):
+        """ Calls the handler, awaiting its result if needed """
+        try:
+            return await self._await_handler(timeout, handler, args, kwargs)
+        except asyncio.TimeoutError:
+            if timeout <= 0:
+                raise   #raised by the handler itself
+            msg = 'Execution was cancelled after %ss'
+            raise HandlerTimeout(msg % timeout)
+    
+    async def _await_handler(self, timeout, handler, args, kwargs):
+        """ Calls the handler, enforcing the timeout through wait_for """
+        if timeout > 0 and not _is_async(handler):
+            loop = asyncio.get_running_loop()
+            call = loop.run_in_executor(None, functools.partial(
+                handler, *args, **kwargs))
+            return await asyncio.wait_for(call, timeout)
+            
+        result = handler(*args, **kwargs)
+        if inspect.isawaitable(result):
+            if timeout > 0:
+                return await asyncio.wait_for(result, timeout)
+            return await result
+        return result
+    
+    __call__ = fire
+
+def _is_async(handler):
+    """ Returns True for coroutine functions and AsyncEvents """
+    return isinstance(handler, AsyncEvent) or \
+           asyncio.iscoroutinefunction(handler)
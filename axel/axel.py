@@ -11,7 +11,14 @@
 # Source: http://pypi.python.org/pypi/axel
 # Docs:   http://packages.python.org/axel
 
-import sys, threading, Queue
+import sys, time, threading, collections, weakref
+try:
+    import Queue
+except ImportError:     #Python 3
+    import queue as Queue
+
+_RLOCKS = (threading._RLock, type(threading.RLock()))
+_STRINGS = (bytes, type(u''))
 
 class Event(object):
     """ 
@@ -53,24 +60,60 @@ class Event(object):
     """
 
     def __init__(self, sender=None, asynch=False, exc_info=False, 
-                 lock=None, threads=3, traceback=False):
+                 lock=None, threads=3, traceback=False, pool=None, 
+                 inline=False, cache_size=128, cache_ttl=None, 
+                 executor=None, batch_items=None, batch_bytes=None, 
+                 batch_latency=None, weak=False, stats=False):
         """ Creates an event 
         
         asynch
             if True handler's are executes asynchronous
+        batch_bytes
+            if set, the event coalesces its payloads and delivers them once 
+            the string arguments of the buffered fires reach this size
+        batch_items
+            if set, the event coalesces its payloads and delivers them once 
+            this number of fires is buffered
+        batch_latency
+            if set, the event coalesces its payloads and delivers them at 
+            most this number of seconds after the first buffered fire
+        cache_size
+            maximum number of memoized results kept per handler, 128 by 
+            default. The least recently used result is evicted first. If 
+            None, no limit applies and memory grows with every new set of 
+            arguments unless cache_ttl is given
+        cache_ttl
+            number of seconds a memoized result stays valid. If None, 
+            memoized results never expire
         exc_info
             if True, result will contain sys.exc_info()[:2] on error
+        executor
+            TimeoutExecutor running the handlers registered with a timeout. 
+            If None, an executor shared by all events is used
+        inline
+            if True, synchronous fires execute the handlers one after the 
+            other in the caller's thread. A synchronous event having a single 
+            handler is always executed inline
         lock
             threading.RLock used to synchronize execution
+        pool
+            WorkerPool used to execute the handlers. If None, up to threads
+            new threads are started on every fire
         sender
             event's sender. The sender is passed as the first argument to the 
             handler, only if is not None. For this case the handler must have
             a placeholder in the arguments to receive the sender
+        stats
+            if True, per handler statistics are recorded, see stats
         threads
             maximum number of threads that will be started
         traceback
             if True, the execution result will contain sys.exc_info() 
             on error. exc_info must be also True to get the traceback      
+        weak
+            if True, bound methods are registered through a weak reference
+            to their instance, so subscribing does not keep the instance 
+            alive. Handlers whose instance was collected are discarded
                 
         hash = hash(handler)
         
@@ -79,17 +122,20 @@ class Event(object):
                 hash : (handler, memoize, timeout),
                 hash : (handler, memoize, timeout), ... 
             }
-        The execution result is cached using the following structure    
-            memoize = { 
-                hash : ((args, kwargs, result), (args, kwargs, result), ...), 
-                hash : ((args, kwargs, result), ...), ...                      
-            } 
+        The execution result is cached in a MemoizeCache, indexed by the 
+        handler's hash and the execution arguments
         The execution result is returned as a tuple having this structure
             exec_result = (
                 (True, result, handler),        # on success
                 (False, error_info, handler),   # on error 
                 (None, None, handler), ...      # asynchronous execution
             )
+            
+        A coalescing event buffers the arguments of every fire and returns 
+        None. Once the batch is due, see flush, handlers registered with 
+        batch=True are executed once with the list of buffered payloads
+            payloads = [(args, kwargs), (args, kwargs), ...]
+        and all other handlers are executed once per buffered fire.
         """        
         self.asynchronous = asynch
         self.exc_info = exc_info
@@ -97,8 +143,20 @@ class Event(object):
         self.sender = sender
         self.threads = threads
         self.traceback = traceback        
+        self.pool = pool
+        self.inline = inline
+        self.executor = executor
+        self.weak = weak
+        self.profiler = None
+        if stats:
+            self.enable_stats()
         self.handlers = {}
-        self.memoize = {}
+        self.batch_handlers = set()
+        self.memoize = MemoizeCache(cache_size, cache_ttl)
+        self.batch = None
+        if batch_items or batch_bytes or batch_latency is not None:
+            self.batch = _Batch(self.flush, batch_items, batch_bytes, 
+                                batch_latency)
 
     def handle(self, handler):
         """ Registers a handler. The handler can be transmitted together 
@@ -112,13 +170,30 @@ class Event(object):
         If arguments are provided as a list, they are considered to have 
         this sequence: (handler, memoize, timeout)                
         
+        Handlers of a coalescing event that want to receive the buffered 
+        payloads at once must be registered as a dictionary having 
+        batch=True. A bound method registered as a dictionary having 
+        weak=True is referenced weakly, whatever the event's weak setting.
+        
         Examples:
             event += handler    
             event += (handler, True, 1.5)
             event += {'handler':handler, 'memoize':True, 'timeout':1.5}         
+            event += {'handler':handler, 'batch':True}
+            event += {'handler':obj.method, 'weak':True}
         """        
         handler_, memoize, timeout = self._extract(handler)
-        self.handlers[hash(handler_)] = (handler_, memoize, timeout)
+        key = hash(handler_)
+        weak = self.weak
+        if isinstance(handler, dict):
+            weak = handler.get('weak', weak)
+        if weak and _WeakMethod.supports(handler_):
+            handler_ = _WeakMethod(handler_, self._pruner(key))
+        self.handlers[key] = (handler_, memoize, timeout)
+        if isinstance(handler, dict) and handler.get('batch'):
+            self.batch_handlers.add(key)
+        else:
+            self.batch_handlers.discard(key)
         return self    
 
     def unhandle(self, handler):
@@ -128,33 +203,70 @@ class Event(object):
         if not key in self.handlers:
             raise ValueError('Handler "%s" was not found' % str(handler_))
         del self.handlers[key]
+        self.batch_handlers.discard(key)
         return self
 
     def fire(self, *args, **kwargs):
-        """ Stores all registered handlers in a queue for processing """        
-        self.queue = Queue.Queue()
-        self.result = []    
-                
-        if self.handlers:
-            max_threads = self._threads() 
-               
-            for i in range(max_threads):
-                t = threading.Thread(target=self._execute, 
-                                     args=args, kwargs=kwargs)            
-                t.daemon = True
-                t.start()
+        """ Dispatches the registered handlers for processing. Every fire 
+        works on its own snapshot of the handlers and its own queue and 
+        result list, so a single event can be fired concurrently """        
+        if self.batch is not None:
+            if self.batch.add(args, kwargs):
+                return self.flush()
+            return None
+        return self._dispatch([h for k, h in self._resolve()], args, kwargs)
     
-            for handler in self.handlers:
-                self.queue.put(handler)
+    def flush(self):
+        """ Delivers the payloads buffered by a coalescing event. Called 
+        when batch_items or batch_bytes is reached and batch_latency 
+        seconds after the first buffered fire, it can also be called 
+        explicitly. Returns the execution results of all deliveries """
+        if self.batch is None:
+            return None
+        
+        self.batch.delivery.acquire()   #deliver batches in order
+        try:
+            payloads = self.batch.take()
+            if not payloads:
+                return None
                 
-                if self.asynchronous:
-                    handler_, memoize, timeout = self.handlers[handler]
-                    self.result.append((None, None, handler_))    
-                                                                        
-            if not self.asynchronous:
-                self.queue.join()
-
-        return tuple(self.result) or None
+            batch, single = [], []
+            for key, handler in self._resolve():
+                if key in self.batch_handlers:
+                    batch.append(handler)
+                else:
+                    single.append(handler)
+                    
+            result = []
+            if batch:
+                result.extend(self._dispatch(batch, (payloads,), {}))
+            if single:
+                for args, kwargs in payloads:
+                    result.extend(self._dispatch(single, args, kwargs))
+            return tuple(result) or None
+        finally:
+            self.batch.delivery.release()
+        
+    def _dispatch(self, handlers, args, kwargs):
+        """ Executes the given handlers according to the execution mode """
+        if not handlers:
+            return None
+        
+        queued = None
+        if self.profiler is not None:
+            queued = self.profiler.fired()
+        
+        if not self.asynchronous:
+            if self.inline or len(handlers) == 1:
+                return self._fire_inline(handlers, args, kwargs)
+            
+        if self.pool is not None:
+            if self.pool.is_worker() and not self.asynchronous:
+                #avoid pool starvation
+                return self._fire_inline(handlers, args, kwargs) 
+            return self._fire_pool(handlers, args, kwargs, queued)
+        
+        return self._fire_threads(handlers, args, kwargs, queued)
 
     def count(self):
         """ Returns the count of registered handlers """
@@ -163,35 +275,186 @@ class Event(object):
     def clear(self):
         """ Discards all registered handlers and cached results """
         self.handlers.clear()
+        self.batch_handlers.clear()
         self.memoize.clear()
 
-    def _execute(self, *args, **kwargs):
+    def memoize_stats(self):
+        """ Returns the memoize counters as a dictionary having the keys
+        hits, misses, evictions and size """
+        return self.memoize.stats()
+    
+    def enable_stats(self):
+        """ Starts recording per handler statistics """
+        if self.profiler is None:
+            self.profiler = _Profiler()
+        self.profiler.recording = True
+        
+    def disable_stats(self):
+        """ Stops recording statistics and discards the recorded ones. 
+        Registered hooks keep being called """
+        if self.profiler is not None:
+            if self.profiler.hooks:
+                self.profiler.recording = False
+                self.profiler.reset()
+            else:
+                self.profiler = None
+                
+    def stats(self):
+        """ Returns a snapshot of the recorded statistics, None if they 
+        are not enabled. The snapshot has this structure
+            stats = {
+                'fires': count,
+                'memoize': {'hits':.., 'misses':.., 'evictions':.., 'size':..},
+                'handlers': [{
+                    'handler': name,
+                    'calls': count,
+                    'errors': count,        # including timeouts
+                    'timeouts': count,
+                    'memoize_hits': count,
+                    'total_time': seconds,
+                    'max_time': seconds,
+                    'queue_wait': seconds,  # total time spent queued
+                    'histogram': ((upper_bound, count), ...)
+                }, ...]
+            }
+        The latency histogram has power of ten buckets from 100 us to 10 s, 
+        the last bucket having None as upper bound.
+        """
+        profiler = self.profiler
+        if profiler is None or not profiler.recording:
+            return None
+        snapshot = profiler.snapshot()
+        snapshot['memoize'] = self.memoize.stats()
+        return snapshot
+    
+    def add_hook(self, before=None, after=None):
+        """ Registers callables invoked around every handler execution
+            before(event, handler, args, kwargs)
+            after(event, handler, result, elapsed)
+        result is the handler's execution result tuple and elapsed the 
+        execution time in seconds. Errors raised by hooks are ignored """
+        if self.profiler is None:
+            self.profiler = _Profiler()
+            self.profiler.recording = False
+        self.profiler.hooks.append((before, after))
+        
+    def remove_hook(self, before=None, after=None):
+        """ Unregisters hooks registered by add_hook """
+        if self.profiler is None or (before, after) not in self.profiler.hooks:
+            raise ValueError('Hook "%s" was not found' % str((before, after)))
+        self.profiler.hooks.remove((before, after))
+        if not self.profiler.hooks and not self.profiler.recording:
+            self.profiler = None
+
+    def _resolve(self):
+        """ Returns a snapshot of the registered handlers as a list of 
+        (hash, (handler, memoize, timeout)), dereferencing weak handlers """
+        items = []
+        for key, (handler, memoize, timeout) in list(self.handlers.items()):
+            if isinstance(handler, _WeakMethod):
+                handler = handler()
+                if handler is None:
+                    continue    #being pruned
+            items.append((key, (handler, memoize, timeout)))
+        return items
+    
+    def _pruner(self, key):
+        """ Returns the callback discarding a weak handler once its 
+        instance is collected """
+        event = weakref.ref(self)
+        def prune(ref):
+            self_ = event()
+            if self_ is None:
+                return
+            entry = self_.handlers.get(key)
+            if entry and isinstance(entry[0], _WeakMethod) and \
+                    entry[0]() is None:
+                self_.handlers.pop(key, None)
+                self_.batch_handlers.discard(key)
+                self_.memoize.discard(key)
+        return prune
+
+    def _execute(self, queue, dispatch, args, kwargs, queued):
         """ Executes all handlers stored in the queue """        
         while True:
             try:
-                handler, memoize, timeout = self.handlers[self.queue.get()]
-                
-                if isinstance(self.lock, threading._RLock):
-                    self.lock.acquire() #synchronization
-                
-                try:
-                    r = self._memoize(memoize, timeout, handler, *args, **kwargs)
-                    if not self.asynchronous:
-                        self.result.append(tuple(r))
-
-                except Exception as err:
-                    if not self.asynchronous: 
-                        self.result.append((False, self._error(sys.exc_info()), 
-                                            handler))                
-                finally:
-                    if isinstance(self.lock, threading._RLock):
-                        self.lock.release() 
-                    
-                    if not self.asynchronous:    
-                        self.queue.task_done()
-                    
+                handler, memoize, timeout = queue.get_nowait()
             except Queue.Empty:
                 break
+            
+            try:
+                if dispatch is None:
+                    self._call(handler, memoize, timeout, args, kwargs, 
+                               queued)
+                else:
+                    dispatch.collect(self._call, handler, memoize, timeout, 
+                                     args, kwargs, queued)
+            except BaseException:
+                pass    #stored by collect, keep draining the queue
+
+    def _fire_threads(self, handlers, args, kwargs, queued=None):
+        """ Starts up to self.threads threads that process the handlers """
+        queue = Queue.Queue()
+        for handler in handlers:
+            queue.put(handler)
+            
+        dispatch = None
+        if not self.asynchronous:
+            dispatch = _Dispatch(len(handlers))
+            
+        for i in range(self._threads(handlers)):
+            t = threading.Thread(target=self._execute, 
+                                 args=(queue, dispatch, args, kwargs, 
+                                       queued))
+            t.daemon = True
+            t.start()
+
+        if dispatch is None:
+            return tuple((None, None, handler) for handler, m, t in handlers)
+        return dispatch.wait()
+
+    def _fire_inline(self, handlers, args, kwargs):
+        """ Executes the handlers in the caller's thread, no queue involved """
+        result = []
+        for handler, memoize, timeout in handlers:
+            result.append(self._call(handler, memoize, timeout, args, kwargs))
+        return tuple(result)
+
+    def _fire_pool(self, handlers, args, kwargs, queued=None):
+        """ Submits the handlers to the worker pool for processing """
+        if self.asynchronous:
+            result = []
+            for handler, memoize, timeout in handlers:
+                self.pool.submit(self._call, handler, memoize, timeout, 
+                                 args, kwargs, queued)
+                result.append((None, None, handler))
+            return tuple(result)
+        
+        dispatch = _Dispatch(len(handlers))
+        for handler, memoize, timeout in handlers:
+            self.pool.submit(dispatch.collect, self._call, handler, memoize, 
+                             timeout, args, kwargs, queued)
+        return dispatch.wait()
+
+    def _call(self, handler, memoize, timeout, args, kwargs, queued=None):
+        """ Executes a single handler and returns its execution result """
+        if self.profiler is not None:
+            return self.profiler.call(self, handler, memoize, timeout, 
+                                      args, kwargs, queued)
+        return self._invoke(handler, memoize, timeout, args, kwargs)
+    
+    def _invoke(self, handler, memoize, timeout, args, kwargs):
+        """ Executes a single handler, synchronized by self.lock """
+        if isinstance(self.lock, _RLOCKS):
+            self.lock.acquire() #synchronization
+        try:
+            return tuple(self._memoize(memoize, timeout, handler, 
+                                       *args, **kwargs))
+        except Exception:
+            return (False, self._error(sys.exc_info()), handler)
+        finally:
+            if isinstance(self.lock, _RLOCKS):
+                self.lock.release()
                         
     def _extract(self, queue_item):
         """ Extracts a handler and handler's arguments that can be provided 
@@ -223,12 +486,8 @@ class Event(object):
         return (handler, bool(memoize), float(timeout))
                 
     def _memoize(self, memoize, timeout, handler, *args, **kwargs):
-        """ Caches the execution result of successful executions        
-        hash = hash(handler)
-        memoize = { 
-            hash : ((args, kwargs, result), (args, kwargs, result), ...), 
-            hash : ((args, kwargs, result), ...), ...                       
-        }
+        """ Caches the execution result of successful executions in 
+        self.memoize, see MemoizeCache
         """     
         if not isinstance(handler, Event) and self.sender is not None:
             args = list(args)[:]
@@ -245,10 +504,11 @@ class Event(object):
             return [True, result, handler]                
         else:
             hash_ = hash(handler)            
-            if hash_ in self.memoize:
-                for args_, kwargs_, result in self.memoize[hash_]:
-                    if args_ == args and kwargs_ == kwargs:                        
-                        return [True, result, handler]
+            result = self.memoize.get(hash_, args, kwargs)
+            if result is not _MISSING:
+                if self.profiler is not None:
+                    _local.memoize_hit = True
+                return [True, result, handler]
                     
             if timeout <= 0:    #no time restriction
                 result = handler(*args, **kwargs)
@@ -258,39 +518,21 @@ class Event(object):
                     if isinstance(result[1], Exception): #error occurred
                         return [False, self._error(result), handler]
                 
-            lock = threading.RLock()
-            lock.acquire()
-            try:
-                if hash_ not in self.memoize:
-                    self.memoize[hash_] = []
-                self.memoize[hash_].append((args, kwargs, result))
-                return [True, result, handler]
-            finally:
-                lock.release()
+            self.memoize.put(hash_, args, kwargs, result)
+            return [True, result, handler]
 
     def _timeout(self, timeout, handler, *args, **kwargs):
         """ Controls the time allocated for the execution of a method """        
-        t = spawn_thread(target=handler, args=args, kwargs=kwargs)
-        t.daemon = True
-        t.start()
-        t.join(timeout)
-        
-        if not t.is_alive():
-            if t.exc_info:
-                return t.exc_info
-            return t.result
-        else:
-            try:
-                msg = '[%s] Execution was forcefully terminated'                
-                raise RuntimeError(msg % t.name)
-            except:
-                return sys.exc_info()
+        executor = self.executor
+        if executor is None:
+            executor = TimeoutExecutor.shared()
+        return executor.run(timeout, handler, args, kwargs)
     
-    def _threads(self):
+    def _threads(self, handlers):
         """ Calculates maximum number of threads that will be started """                
-        if self.threads < len(self.handlers):
+        if self.threads < len(handlers):
             return self.threads
-        return len(self.handlers)
+        return len(handlers)
 
     def _error(self, exc_info):     
         """ Retrieves the error info """            
@@ -305,6 +547,683 @@ class Event(object):
     __call__ = fire
     __len__  = count
 
+_MISSING = object()
+
+class MemoizeCache(object):
+    """ 
+    Bounded cache of handler execution results, used by Event to memoize.
+    Results are indexed by the handler's hash and by the execution 
+    arguments, so lookups of hashable arguments take constant time. 
+    Unhashable arguments fall back to a linear scan using ==.
+    
+        cache = { 
+            hash : OrderedDict({(args, kwargs) : (result, expires), ...}),
+            hash : OrderedDict(...), ...
+        }
+        unhashable = {
+            hash : [(args, kwargs, result, expires), ...], ...
+        }
+        
+    Each handler keeps at most maxsize results of either kind, the least 
+    recently used one being evicted first. Results older than ttl seconds 
+    are discarded on lookup, and put sweeps all expired results once per 
+    ttl period, so a ttl bounds memory even without maxsize.
+    """
+    
+    def __init__(self, maxsize=None, ttl=None):
+        """ Creates a cache 
+        
+        maxsize
+            maximum number of results kept per handler, None for no limit
+        ttl
+            number of seconds a result stays valid, None for no expiry
+        """
+        assert maxsize is None or maxsize > 0, 'Invalid cache size'
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.cache = {}
+        self.unhashable = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.next_purge = None
+        self.lock = threading.RLock()
+        
+    def get(self, hash_, args, kwargs):
+        """ Returns the cached result or _MISSING """
+        key = self._key(args, kwargs)
+        now = time.time()
+        self.lock.acquire()
+        try:
+            if key is None:
+                result = self._get_unhashable(hash_, args, kwargs, now)
+            else:
+                result = _MISSING
+                entries = self.cache.get(hash_)
+                if entries is not None and key in entries:
+                    result, expires = entries.pop(key)
+                    if expires is not None and expires <= now:
+                        result = _MISSING
+                    else:
+                        entries[key] = (result, expires)  #most recently used
+            
+            if result is _MISSING:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return result
+        finally:
+            self.lock.release()
+            
+    def put(self, hash_, args, kwargs, result):
+        """ Stores the result, evicting the least recently used one if the 
+        handler's limit is reached """
+        key = self._key(args, kwargs)
+        expires = None
+        if self.ttl is not None:
+            now = time.time()
+            expires = now + self.ttl
+        self.lock.acquire()
+        try:
+            if expires is not None:
+                if self.next_purge is None or self.next_purge <= now:
+                    self._purge(now)
+                    self.next_purge = expires
+                    
+            if key is None:
+                entries = self.unhashable.setdefault(hash_, [])
+                entries.append((args, kwargs, result, expires))
+                if self.maxsize is not None and len(entries) > self.maxsize:
+                    del entries[0]
+                    self.evictions += 1
+            else:
+                entries = self.cache.get(hash_)
+                if entries is None:
+                    entries = self.cache[hash_] = collections.OrderedDict()
+                entries.pop(key, None)
+                entries[key] = (result, expires)
+                if self.maxsize is not None and len(entries) > self.maxsize:
+                    entries.popitem(last=False)
+                    self.evictions += 1
+        finally:
+            self.lock.release()
+            
+    def discard(self, hash_):
+        """ Discards all results cached for a handler """
+        self.lock.acquire()
+        try:
+            self.cache.pop(hash_, None)
+            self.unhashable.pop(hash_, None)
+        finally:
+            self.lock.release()
+            
+    def clear(self):
+        """ Discards all cached results and resets the counters """
+        self.lock.acquire()
+        try:
+            self.cache.clear()
+            self.unhashable.clear()
+            self.hits = self.misses = self.evictions = 0
+        finally:
+            self.lock.release()
+            
+    def stats(self):
+        """ Returns the counters as a dictionary """
+        self.lock.acquire()
+        try:
+            return {'hits': self.hits, 
+                    'misses': self.misses, 
+                    'evictions': self.evictions, 
+                    'size': len(self)}
+        finally:
+            self.lock.release()
+            
+    def __contains__(self, hash_):
+        return hash_ in self.cache or hash_ in self.unhashable
+            
+    def __len__(self):
+        return sum(len(e) for e in self.cache.values()) + \
+               sum(len(e) for e in self.unhashable.values())
+               
+    def _purge(self, now):
+        """ Discards all expired results """
+        for hash_, entries in list(self.cache.items()):
+            for key, (result, expires) in list(entries.items()):
+                if expires is not None and expires <= now:
+                    del entries[key]
+            if not entries:
+                del self.cache[hash_]
+        for hash_, entries in list(self.unhashable.items()):
+            entries[:] = [e for e in entries if e[3] is None or e[3] > now]
+            if not entries:
+                del self.unhashable[hash_]
+        
+    def _get_unhashable(self, hash_, args, kwargs, now):
+        """ Scans the results stored for unhashable arguments """
+        entries = self.unhashable.get(hash_, ())
+        for i, (args_, kwargs_, result, expires) in enumerate(entries):
+            if args_ == args and kwargs_ == kwargs:
+                del entries[i]
+                if expires is not None and expires <= now:
+                    return _MISSING
+                entries.append((args_, kwargs_, result, expires))
+                return result
+        return _MISSING
+        
+    def _key(self, args, kwargs):
+        """ Builds a hashable key out of the arguments, None if some 
+        argument is unhashable """
+        key = (tuple(args), tuple(sorted(kwargs.items())))
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+class _WeakMethod(object):
+    """ Weak reference to a bound method, calling it returns the bound 
+    method or None once the instance was collected """
+    
+    def __init__(self, method, callback=None):
+        self.func = method.__func__
+        self.ref = weakref.ref(method.__self__, callback)
+        
+    def __call__(self):
+        obj = self.ref()
+        if obj is None:
+            return None
+        return self.func.__get__(obj, type(obj))
+    
+    @staticmethod
+    def supports(handler):
+        """ Returns True if handler is a method bound to an instance that 
+        can be weakly referenced """
+        self_ = getattr(handler, '__self__', None)
+        if self_ is None or not hasattr(handler, '__func__'):
+            return False
+        try:
+            weakref.ref(self_)
+        except TypeError:
+            return False
+        return True
+
+class _HandlerStats(object):
+    """ Statistics recorded for a single handler """
+    
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.memoize_hits = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.queue_wait = 0.0
+        self.histogram = [0] * (len(_Profiler.BUCKETS) + 1)
+
+class _Profiler(object):
+    """ Records the statistics and calls the hooks of an event """
+    
+    BUCKETS = (0.0001, 0.001, 0.01, 0.1, 1.0, 10.0)
+    
+    def __init__(self):
+        self.recording = True
+        self.hooks = []
+        self.lock = threading.Lock()
+        self.reset()
+        
+    def reset(self):
+        self.fires = 0
+        self.handlers = {}
+        
+    def fired(self):
+        """ Counts a fire, returns the time its handlers were queued """
+        if self.recording:
+            self.lock.acquire()
+            self.fires += 1
+            self.lock.release()
+        return time.time()
+        
+    def call(self, event, handler, memoize, timeout, args, kwargs, queued):
+        """ Executes the handler through event._invoke, calling the hooks 
+        and recording the statistics """
+        self.before(event, handler, args, kwargs)
+        _local.memoize_hit = False
+        start = time.time()
+        result = event._invoke(handler, memoize, timeout, args, kwargs)
+        self.after(event, handler, result, start, queued, _local.memoize_hit)
+        return result
+    
+    def before(self, event, handler, args, kwargs):
+        """ Calls the before hooks of a handler execution """
+        for before, after in self.hooks:
+            if before is not None:
+                try:
+                    before(event, handler, args, kwargs)
+                except Exception:
+                    pass
+                    
+    def after(self, event, handler, result, start, queued, hit):
+        """ Records a handler execution started at start and calls the 
+        after hooks """
+        elapsed = time.time() - start
+        if self.recording:
+            self.record(handler, result, elapsed, start - (queued or start),
+                        hit)
+            
+        for before, after in self.hooks:
+            if after is not None:
+                try:
+                    after(event, handler, result, elapsed)
+                except Exception:
+                    pass
+    
+    def record(self, handler, result, elapsed, wait, hit):
+        """ Adds an execution to the handler's statistics """
+        key = hash(handler)
+        self.lock.acquire()
+        try:
+            stats = self.handlers.get(key)
+            if stats is None:
+                stats = self.handlers[key] = _HandlerStats(_name(handler))
+            stats.calls += 1
+            stats.total_time += elapsed
+            stats.max_time = max(stats.max_time, elapsed)
+            stats.queue_wait += wait
+            if hit:
+                stats.memoize_hits += 1
+            if result[0] is False:
+                stats.errors += 1
+                error = result[1]
+                if isinstance(error, tuple):    #exc_info
+                    error = error[1]
+                if isinstance(error, HandlerTimeout):
+                    stats.timeouts += 1
+            for i, bound in enumerate(self.BUCKETS):
+                if elapsed < bound:
+                    break
+            else:
+                i = len(self.BUCKETS)
+            stats.histogram[i] += 1
+        finally:
+            self.lock.release()
+            
+    def snapshot(self):
+        """ Returns the statistics as a dictionary, see Event.stats """
+        bounds = self.BUCKETS + (None,)
+        self.lock.acquire()
+        try:
+            handlers = []
+            for stats in self.handlers.values():
+                handlers.append({
+                    'handler': stats.name,
+                    'calls': stats.calls,
+                    'errors': stats.errors,
+                    'timeouts': stats.timeouts,
+                    'memoize_hits': stats.memoize_hits,
+                    'total_time': stats.total_time,
+                    'max_time': stats.max_time,
+                    'queue_wait': stats.queue_wait,
+                    'histogram': tuple(zip(bounds, stats.histogram))})
+            return {'fires': self.fires, 'handlers': handlers}
+        finally:
+            self.lock.release()
+
+def _name(handler):
+    """ Returns a readable name for a handler """
+    name = getattr(handler, '__name__', None)
+    if name is None:
+        return repr(handler)
+    self_ = getattr(handler, '__self__', None)
+    if self_ is not None:
+        return '%s.%s' % (type(self_).__name__, name)
+    return '%s.%s' % (getattr(handler, '__module__', None), name)
+
+class _Batch(object):
+    """ Payloads buffered by a coalescing event """
+    
+    def __init__(self, flush, max_items, max_bytes, latency):
+        self.flush = flush
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.latency = latency
+        self.payloads = []
+        self.size = 0
+        self.timer = None
+        self.lock = threading.Lock()
+        self.delivery = threading.RLock()  #handlers may fire the event
+        
+    def add(self, args, kwargs):
+        """ Buffers a payload, returns True if the batch is due """
+        self.lock.acquire()
+        try:
+            self.payloads.append((args, kwargs))
+            if self.max_bytes:
+                for arg in args:
+                    if isinstance(arg, _STRINGS):
+                        self.size += len(arg)
+                        
+            if self.max_items and len(self.payloads) >= self.max_items:
+                return True
+            if self.max_bytes and self.size >= self.max_bytes:
+                return True
+            
+            if self.latency is not None and self.timer is None:
+                self.timer = threading.Timer(self.latency, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+            return False
+        finally:
+            self.lock.release()
+            
+    def take(self):
+        """ Returns and discards the buffered payloads """
+        self.lock.acquire()
+        try:
+            payloads = self.payloads
+            self.payloads = []
+            self.size = 0
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            return payloads
+        finally:
+            self.lock.release()
+
+class _Dispatch(object):
+    """ Collects the execution results of a single fire """
+    
+    def __init__(self, pending):
+        self.pending = pending
+        self.result = []
+        self.done = threading.Condition(threading.Lock())
+        
+    def collect(self, call, handler, *args):
+        """ Executes call(handler, *args) and stores its result. Errors the 
+        call does not handle, like SystemExit, are stored as a failure """
+        r = (False, None, handler)
+        try:
+            r = call(handler, *args)
+        except BaseException:
+            r = (False, sys.exc_info()[1], handler)
+            raise
+        finally:
+            self.done.acquire()
+            try:
+                self.result.append(r)
+                self.pending -= 1
+                if self.pending <= 0:
+                    self.done.notify_all()
+            finally:
+                self.done.release()
+            
+    def wait(self):
+        """ Blocks until all results were collected """
+        self.done.acquire()
+        try:
+            while self.pending > 0:
+                self.done.wait()
+        finally:
+            self.done.release()
+        return tuple(self.result) or None
+
+class WorkerPool(object):
+    """ 
+    Long-lived, bounded pool of daemon threads that can be shared by 
+    several events. Threads are started on demand, up to size, and are 
+    reused across fires until the pool is shut down.
+    
+    from axel import Event, WorkerPool
+    
+    pool = WorkerPool(size=4)
+    event = Event(pool=pool)
+    ...
+    pool.shutdown()
+    """
+    
+    def __init__(self, size=3, name='axel-worker'):
+        """ Creates a pool 
+        
+        name
+            prefix of the worker thread names
+        size
+            maximum number of threads that will be started
+        """
+        assert size > 0, 'Invalid pool size'
+        self.size = size
+        self.name = name
+        self.closed = False
+        self.queue = Queue.Queue()
+        self.workers = []
+        self.idle = 0
+        self.lock = threading.Lock()
+        
+    def submit(self, target, *args, **kwargs):
+        """ Queues target for execution by one of the worker threads """
+        self.lock.acquire()
+        try:
+            if self.closed:
+                raise RuntimeError('Pool "%s" was shut down' % self.name)
+            self.queue.put((target, args, kwargs))
+            if self.idle < self.queue.qsize() and \
+                    len(self.workers) < self.size:
+                t = threading.Thread(target=self._work, name='%s-%d' % 
+                                     (self.name, len(self.workers)))
+                t.daemon = True
+                self.workers.append(t)
+                t.start()
+        finally:
+            self.lock.release()
+            
+    def is_worker(self):
+        """ Returns True if called from one of the pool's threads """
+        return threading.current_thread() in self.workers
+    
+    def shutdown(self, wait=True):
+        """ Stops the worker threads once the queued jobs are processed. 
+        If wait is True, blocks until all worker threads have exited """
+        self.lock.acquire()
+        try:
+            if self.closed:
+                return
+            self.closed = True
+            workers = self.workers[:]
+            for t in workers:
+                self.queue.put(None)
+        finally:
+            self.lock.release()
+            
+        if wait:
+            current = threading.current_thread()
+            for t in workers:
+                if t is not current:
+                    t.join()
+        
+    def _work(self):
+        """ Executes queued jobs until the pool is shut down """
+        while True:
+            self.lock.acquire()
+            self.idle += 1
+            self.lock.release()
+            
+            job = self.queue.get()
+            
+            self.lock.acquire()
+            self.idle -= 1
+            self.lock.release()
+            
+            if job is None:
+                break
+            target, args, kwargs = job
+            try:
+                target(*args, **kwargs)
+            except BaseException:
+                pass    #errors are reported by the target, keep the thread
+            
+_local = threading.local()
+
+def current_token():
+    """ Returns the CancelToken of the timed handler executing in the 
+    current thread, or None if the handler was registered without timeout.
+    Long running handlers should check it and return early once the 
+    execution was cancelled:
+    
+    def on_event(*args):
+        token = current_token()
+        for item in work:
+            if token and token.cancelled:
+                return
+            ...
+    """
+    return getattr(_local, 'token', None)
+
+class CancelToken(object):
+    """ Signals a timed handler that its result is no longer awaited """
+    
+    def __init__(self):
+        self._event = threading.Event()
+        
+    def cancel(self):
+        self._event.set()
+        
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+    
+class HandlerTimeout(RuntimeError):
+    """ Error reported for handlers exceeding their timeout """
+
+class _TimedCall(object):
+    """ A single handler execution submitted to a TimeoutExecutor """
+    
+    def __init__(self, target, args, kwargs):
+        self.target = target
+        self.args = args
+        self.kwargs = kwargs
+        self.token = CancelToken()
+        self.done = threading.Event()
+        self.finished = False
+        self.result = None
+        self.exc_info = None
+        
+class TimeoutExecutor(object):
+    """
+    Executes handlers registered with a timeout on a bounded pool of 
+    threads. A handler exceeding its timeout cannot be killed; it is 
+    cancelled through its CancelToken (see current_token) and keeps its 
+    thread until it returns. At most max_outstanding such handlers may be 
+    running at once, further timed executions fail right away instead of 
+    piling up threads.
+    
+    from axel import Event, TimeoutExecutor
+    
+    executor = TimeoutExecutor(size=4, max_outstanding=8)
+    event = Event(executor=executor)
+    event += (handler, False, 1.5)
+    """
+    
+    _shared = None
+    _shared_lock = threading.Lock()
+    
+    def __init__(self, size=3, max_outstanding=16, name='axel-timeout'):
+        """ Creates an executor 
+        
+        max_outstanding
+            maximum number of timed out handlers that may still be running.
+            With 0, timed executions fail while a timed out handler still 
+            runs, and succeed otherwise
+        name
+            prefix of the worker thread names
+        size
+            number of threads available to handlers within their timeout
+        """
+        assert max_outstanding >= 0, 'Invalid number of outstanding calls'
+        self.max_outstanding = max_outstanding
+        self.pool = WorkerPool(size + max_outstanding, name)
+        self.lock = threading.Lock()
+        self.running = 0
+        self.abandoned = set()
+        
+    @classmethod
+    def shared(cls):
+        """ Returns the executor shared by events without an executor """
+        cls._shared_lock.acquire()
+        try:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+        finally:
+            cls._shared_lock.release()
+    
+    @property
+    def outstanding(self):
+        """ Number of timed out handlers that are still running """
+        return len(self.abandoned)
+        
+    def run(self, timeout, target, args=(), kwargs={}):
+        """ Executes target, waiting at most timeout seconds for it. Returns
+        the result, or sys.exc_info() if target failed or timed out """
+        call = _TimedCall(target, args, kwargs)
+        try:
+            self.lock.acquire()
+            try:
+                if self.abandoned and \
+                        len(self.abandoned) >= self.max_outstanding:
+                    msg = '[%s] Too many timed out handlers still running (%d)'
+                    raise RuntimeError(msg % (self.pool.name, 
+                                              len(self.abandoned)))
+            finally:
+                self.lock.release()
+            self.pool.submit(self._execute, call)
+        except:
+            return sys.exc_info()
+        
+        call.done.wait(timeout)
+        
+        self.lock.acquire()
+        try:
+            if not call.finished:
+                call.token.cancel()
+                self.abandoned.add(call)
+                try:
+                    msg = '[%s] Execution was cancelled after %ss'                
+                    raise HandlerTimeout(msg % (self.pool.name, timeout))
+                except:
+                    return sys.exc_info()
+        finally:
+            self.lock.release()
+            
+        if call.exc_info:
+            return call.exc_info
+        return call.result
+    
+    def shutdown(self, wait=True):
+        """ Stops the worker threads, see WorkerPool.shutdown """
+        self.pool.shutdown(wait)
+    
+    def _execute(self, call):
+        """ Runs a call in a worker thread, skipping cancelled calls """
+        self.lock.acquire()
+        self.running += 1
+        self.lock.release()
+        
+        _local.token = call.token
+        try:
+            if not call.token.cancelled:
+                call.result = call.target(*call.args, **call.kwargs)
+        except:
+            call.exc_info = sys.exc_info()
+        finally:
+            _local.token = None
+            del call.target, call.args, call.kwargs
+            
+            self.lock.acquire()
+            self.running -= 1
+            call.finished = True
+            self.abandoned.discard(call)
+            self.lock.release()
+            call.done.set()
+
 class spawn_thread(threading.Thread):    
     """ Spawns a new thread and returns the execution result """
     
@@ -0,0 +1,142 @@
+'''
+Benchmarks for the axel event dispatching.
+
+Run from the repository root:
+    PYTHONPATH=. python benchmarks/bench_axel.py
+'''
+
+import gc
+import threading
+import time
+
+from axel import Event, WorkerPool
+
+
+def echo(value):
+    return value
+
+
+def stress(event, fires=2000, callers=8):
+    '''
+    Fire the event concurrently from several threads and check that every
+    fire only receives the results of its own handlers.
+    Returns the number of fires per second.
+    '''
+    errors = []
+    handlers = event.count()
+
+    def caller(base):
+        for i in range(fires // callers):
+            value = base + i
+            result = event(value)
+            if len(result) != handlers or \
+                    [r[1] for r in result] != [value] * handlers:
+                errors.append((value, result))
+
+    threads = [threading.Thread(target=caller, args=(n * fires,))
+               for n in range(callers)]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start
+
+    assert not errors, "%d fires received foreign results, e.g. %r" % \
+        (len(errors), errors[0])
+    return fires / elapsed
+
+
+def make_event(handlers=3, **kwargs):
+    event = Event(**kwargs)
+    for i in range(handlers):
+        # distinct function objects, handlers are keyed by hash
+        event += (lambda value: echo(value))
+    return event
+
+
+def bench_concurrent_fire():
+    print("Concurrent fires, 3 handlers, 8 calling threads")
+    print("  threads per fire: %10.0f fires/s" % stress(make_event()))
+    pool = WorkerPool(size=8)
+    try:
+        print("  worker pool:      %10.0f fires/s" %
+              stress(make_event(pool=pool)))
+    finally:
+        pool.shutdown()
+    print("  inline:           %10.0f fires/s" %
+          stress(make_event(inline=True)))
+
+
+def bench_coalescing(fires=100000):
+    print("%d fires of a 10 byte payload" % fires)
+    received = []
+
+    def per_item(data):
+        received.append(data)
+
+    def per_batch(payloads):
+        received.extend(args[0] for args, kwargs in payloads)
+
+    batched = {'handler': per_batch, 'batch': True}
+    for label, event, handler in (
+            ("per fire:         ", Event(), per_item),
+            ("batches of 1000:  ", Event(batch_items=1000), batched),
+            ("batches of 64 kB: ", Event(batch_bytes=65536), batched)):
+        event += handler
+        del received[:]
+        start = time.time()
+        for i in range(fires):
+            event("0123456789")
+        event.flush()
+        elapsed = time.time() - start
+        assert len(received) == fires
+        print("  %s %10.0f fires/s" % (label, fires / elapsed))
+
+
+class Subscriber(object):
+
+    def __init__(self, event):
+        self.payload = [0] * 100
+        event += self.on_event
+
+    def on_event(self, value):
+        return value
+
+
+def bench_subscriber_leak(rounds=10, subscribers=1000):
+    print("%d rounds creating and dropping %d subscribers" %
+          (rounds, subscribers))
+    for label, event in (("strong handlers:", Event()),
+                         ("weak handlers:  ", Event(weak=True))):
+        gc.collect()
+        before = len(gc.get_objects())
+        start = time.time()
+        for i in range(rounds):
+            [Subscriber(event) for n in range(subscribers)]
+            event(i)
+        gc.collect()
+        elapsed = time.time() - start
+        print("  %s %6d handlers left, %+8d objects, %6.3f s" %
+              (label, event.count(), len(gc.get_objects()) - before,
+               elapsed))
+
+
+def bench_stats_overhead(fires=100000):
+    print("%d inline fires of a single handler" % fires)
+    for label, event in (("stats disabled:", Event()),
+                         ("stats enabled: ", Event(stats=True))):
+        event += echo
+        start = time.time()
+        for i in range(fires):
+            event(i)
+        elapsed = time.time() - start
+        print("  %s %10.0f fires/s, %5.2f us per fire" %
+              (label, fires / elapsed, elapsed / fires * 1e6))
+
+
+if __name__ == "__main__":
+    bench_concurrent_fire()
+    bench_coalescing()
+    bench_subscriber_leak()
+    bench_stats_overhead()
@@ -0,0 +1,103 @@
+'''
+Benchmarks for the BlueZ dbus wrappers.
+
+Run from the repository root:
+    PYTHONPATH=. python benchmarks/bench_btdbus.py
+'''
+
+import os
+import resource
+import subprocess
+import sys
+import time
+
+from btsec import btdbus, dbusreplay
+
+
+def cold_start(statement, runs=10):
+    '''
+    Run statement in fresh interpreters, return the best wall time or None
+    if the statement fails, e.g. when there is no BlueZ daemon.
+    '''
+    best = None
+    with open(os.devnull, 'w') as devnull:
+        for i in range(runs):
+            start = time.time()
+            if subprocess.call([sys.executable, "-c", statement],
+                               stderr=devnull):
+                return None
+            elapsed = time.time() - start
+            if best is None or elapsed < best:
+                best = elapsed
+    return best
+
+
+def milliseconds(seconds):
+    if seconds is None:
+        return "    n/a"
+    return "%7.1f ms" % (seconds * 1000)
+
+
+def bench_import():
+    print("Cold start, best of 10 interpreters")
+    baseline = cold_start("pass")
+    lazy = cold_start("import btsec.btdbus")
+    # Importing used to connect to the bus and look up the manager
+    eager = cold_start("import btsec.btdbus as b; b.get_manager()")
+    print("  interpreter only:       %s" % milliseconds(baseline))
+    print("  import btdbus:          %s" % milliseconds(lazy))
+    print("  import and connect:     %s" % milliseconds(eager))
+
+
+def rss():
+    '''
+    Resident memory of this process in bytes, Linux only.
+    '''
+    with open('/proc/self/statm') as statm:
+        pages = int(statm.read().split()[1])
+    return pages * resource.getpagesize()
+
+
+def bench_fleet(sizes=(10, 100, 1000, 10000), sightings=10):
+    print("Synthetic fleets on a fake bus")
+    print("  %7s %12s %12s %14s %12s" % ("devices", "first read", "cached read",
+                                        "DeviceFound", "memory"))
+    for size in sizes:
+        bus = dbusreplay.synthetic_fleet(size)
+        btdbus.set_bus(bus)
+        before = rss()
+
+        adapter = btdbus.get_adapters()[0]
+        devices = adapter.get_devices()
+
+        start = time.time()
+        for device in devices:
+            device.name
+        first = (time.time() - start) / size
+
+        start = time.time()
+        for device in devices:
+            device.name
+            device.address
+            device.paired
+        cached = (time.time() - start) / (size * 3)
+
+        values = {'RSSI': -60, 'Class': 0x5a020c}
+        addresses = [dbusreplay.fleet_address(i) for i in range(size)]
+        start = time.time()
+        for i in range(sightings):
+            for address in addresses:
+                bus.emit(adapter.object_path, 'org.bluez.Adapter',
+                         'DeviceFound', address, values)
+        throughput = size * sightings / (time.time() - start)
+        assert len(adapter.registry) == size
+
+        memory = float(rss() - before) / size
+        print("  %7d %9.1f us %9.2f us %10.0f sig/s %8.0f B/dev" %
+              (size, first * 1e6, cached * 1e6, throughput, memory))
+        btdbus.forget_wrapper(adapter.object_path, bus)
+
+
+if __name__ == "__main__":
+    bench_import()
+    bench_fleet()
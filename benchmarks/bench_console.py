@@ -0,0 +1,208 @@
+'''
+Benchmarks for the interactive console interpreter.
+
+Needs pygtk. Run from the repository root:
+    PYTHONPATH=. python benchmarks/bench_console.py
+'''
+
+import codeop
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from btsec.gtkconsole import Completer, GtkInterpreter, OutputCatcher
+
+
+def report(line):
+    # The interpreter captures sys.stdout
+    sys.__stdout__.write(line + "\n")
+
+
+class Waiter(object):
+    '''
+    Counts finished commands of an interpreter and waits for a number of them.
+    '''
+
+    def __init__(self, interpreter):
+        self.finished = 0
+        self.condition = threading.Condition()
+        interpreter.command_updated += self.updated
+
+    def updated(self, command, state):
+        if state.finished or state.exec_error or state.compile_error:
+            with self.condition:
+                self.finished += 1
+                self.condition.notify()
+
+    def wait(self, count, timeout=120):
+        deadline = time.time() + timeout
+        with self.condition:
+            while self.finished < count and time.time() < deadline:
+                self.condition.wait(deadline - time.time())
+            return self.finished >= count
+
+
+def bench_single_line(interpreter, waiter, runs=100):
+    latencies = []
+    for i in range(runs):
+        expected = waiter.finished + 1
+        start = time.time()
+        interpreter.feed("x = %d" % i)
+        waiter.wait(expected)
+        latencies.append(time.time() - start)
+    latencies.sort()
+    report("Single line, %d runs" % runs)
+    report("  median:   %7.2f ms" % (latencies[runs // 2] * 1000))
+    report("  worst:    %7.2f ms" % (latencies[-1] * 1000))
+
+
+def bench_paste(interpreter, waiter, lines=500):
+    expected = waiter.finished + lines
+    start = time.time()
+    for i in range(lines):
+        interpreter.feed("y = %d" % i)
+    done = waiter.wait(expected)
+    elapsed = time.time() - start
+    report("Paste of %d lines" % lines)
+    report("  total:    %7.2f ms%s" % (elapsed * 1000,
+                                       "" if done else " (timed out)"))
+
+
+def function_block(lines):
+    source = ["def pasted(x):"]
+    for i in range(lines - 2):
+        source.append("    x = x + %d" % i)
+    source.append("    return x")
+    return source
+
+
+def bench_block(interpreter, waiter, sizes=(100, 500, 2000)):
+    report("Pasted function block")
+    for size in sizes:
+        block = function_block(size)
+
+        # What the interpreter used to do: compile the block at every line
+        start = time.time()
+        source = ""
+        for line in block:
+            source += line + "\n"
+            codeop.compile_command(source[:-1])
+        every_line = time.time() - start
+
+        expected = waiter.finished + 1
+        start = time.time()
+        for line in block:
+            interpreter.feed(line)
+        interpreter.feed("")
+        waiter.wait(expected)
+        fed = time.time() - start
+        report("  %5d lines: %8.1f ms, compiling every line %8.1f ms" %
+               (size, fed * 1000, every_line * 1000))
+
+
+def bench_script(interpreter, waiter, lines=5000):
+    script = tempfile.NamedTemporaryFile(suffix=".py", delete=False)
+    try:
+        for i in range(lines):
+            script.write("value_%d = %d * 2\n" % (i, i))
+        script.close()
+
+        expected = waiter.finished + 1
+        start = time.time()
+        interpreter.run_file(script.name)
+        waiter.wait(expected)
+        whole = time.time() - start
+    finally:
+        os.remove(script.name)
+
+    expected = waiter.finished + lines
+    start = time.time()
+    for i in range(lines):
+        interpreter.feed("value_%d = %d * 2" % (i, i))
+    waiter.wait(expected)
+    by_line = time.time() - start
+
+    report("Script of %d lines" % lines)
+    report("  run_file:   %8.1f ms" % (whole * 1000))
+    report("  line by line: %6.1f ms" % (by_line * 1000))
+
+
+def bench_completion(names=100000, runs=200):
+    lokals = dict(("name_%06d" % i, i) for i in range(names))
+    completer = Completer(lokals)
+    prefixes = ["n", "name_0", "name_05", "name_0999", "na", "xyz", "pr"]
+
+    start = time.time()
+    for i in range(runs):
+        text = prefixes[i % len(prefixes)]
+        completer.complete(text, 0)
+    keystroke = (time.time() - start) / runs
+
+    lokals["lokals"] = lokals
+    completer.update(lokals)
+    start = time.time()
+    for i in range(runs):
+        completer.complete("lokals.ke", 0)
+    attribute = (time.time() - start) / runs
+
+    start = time.time()
+    for i in range(runs):
+        lokals["extra_%d" % i] = i
+        completer.update(lokals)
+    update = (time.time() - start) / runs
+
+    report("Completion with %d names" % len(completer.completions))
+    report("  keystroke:  %7.3f ms" % (keystroke * 1000))
+    report("  attribute:  %7.3f ms" % (attribute * 1000))
+    report("  update:     %7.3f ms" % (update * 1000))
+
+
+def bench_output(lines=100000):
+    report("Printing %d lines" % lines)
+    # max_size=1 passes on every write, like the unbuffered catcher did
+    for label, catcher in (("unbuffered", OutputCatcher(max_size=1)),
+                           ("buffered", OutputCatcher())):
+        received = []
+
+        def output(data):
+            received.append(data)
+        catcher.output_received += output
+        stdout = sys.stdout
+        sys.stdout = catcher
+        start = time.time()
+        try:
+            for i in range(lines):
+                print(i)
+        finally:
+            sys.stdout = stdout
+        catcher.flush()
+        elapsed = time.time() - start
+        report("  %-10s  %7.1f ms, %6d events" % (label, elapsed * 1000,
+                                                  len(received)))
+
+
+def bench_idle(interpreter, seconds=2.0):
+    before = os.times()
+    time.sleep(seconds)
+    after = os.times()
+    cpu = (after[0] - before[0]) + (after[1] - before[1])
+    report("Idle for %.0f s" % seconds)
+    report("  cpu:      %7.2f ms" % (cpu * 1000))
+
+
+if __name__ == "__main__":
+    bench_completion()
+    bench_output()
+    interpreter = GtkInterpreter()
+    waiter = Waiter(interpreter)
+    interpreter.start()
+    try:
+        bench_single_line(interpreter, waiter)
+        bench_paste(interpreter, waiter)
+        bench_block(interpreter, waiter)
+        bench_script(interpreter, waiter)
+        bench_idle(interpreter)
+    finally:
+        interpreter.kill()
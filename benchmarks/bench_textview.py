@@ -0,0 +1,44 @@
+'''
+Benchmarks for the rendering of commands in the terminal.
+
+Needs pygtk and a display. Run from the repository root:
+    PYTHONPATH=. python benchmarks/bench_textview.py
+'''
+
+import sys
+import time
+
+from btsec.gtkconsole import Command
+from btsec.textview import Terminal
+
+
+def report(line):
+    # The interpreter of the terminal captures sys.stdout
+    sys.__stdout__.write(line + "\n")
+
+
+def bench_block(terminal, sizes=(100, 1000, 5000)):
+    report("Rendering a growing block, one update per line")
+    for size in sizes:
+        command = Command("def pasted(x):\n")
+        ops = terminal.buffer_ops
+        start = time.time()
+        terminal.command_created(command, command.state())
+        for i in range(size - 1):
+            command += "    x = x + %d\n" % i
+            terminal.command_updated(command, command.state())
+        command += "\n"
+        command.finished = True
+        terminal.command_updated(command, command.state())
+        elapsed = time.time() - start
+        ops = terminal.buffer_ops - ops
+        report("  %5d lines: %8.1f ms, %5.2f buffer ops per update" %
+               (size, elapsed * 1000, float(ops) / (size + 1)))
+
+
+if __name__ == "__main__":
+    terminal = Terminal()
+    try:
+        bench_block(terminal)
+    finally:
+        terminal.interpreter.kill()
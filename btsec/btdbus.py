@@ -4,15 +4,66 @@ Interface for Bluetooth devices using dbus
 @author: SeelfesteR
 '''
 
+import array
+import bisect
+import collections
+import Queue
+import sys
+import threading
+import time
+
 import dbus
 from axel import Event
-from dbus.mainloop.glib import DBusGMainLoop
 
-DBusGMainLoop(set_as_default=True)
-bus = dbus.SystemBus()
+_bus = None
+_manager = None
+_connect_lock = threading.RLock()
+
+# Identity map of wrappers per bus: {bus: {object_path: wrapper}}
+_wrappers = {}
+_removal_matches = {}   # bus: AdapterRemoved match forgetting its wrappers
+_wrappers_lock = threading.RLock()
+
+# Number of live dbus proxies and signal matches held by wrappers and the
+# identity map
+_counters = {'proxies': 0, 'signal_matches': 0}
+_counters_lock = threading.Lock()
 
-manager_obj = bus.get_object('org.bluez', '/')
-manager = dbus.Interface(manager_obj, 'org.bluez.Manager')
+
+def get_bus():
+    '''
+    Get the bus to talk to BlueZ. Connects to the system bus, using the GLib
+    main loop, on first use unless another bus was set with set_bus.
+    '''
+    global _bus
+    with _connect_lock:
+        if _bus is None:
+            from dbus.mainloop.glib import DBusGMainLoop, threads_init
+            DBusGMainLoop(set_as_default=True)
+            threads_init()
+            _bus = dbus.SystemBus()
+        return _bus
+
+def set_bus(bus):
+    '''
+    Use the given bus instead of the system bus, e.g. a connection to a 
+    private dbus-daemon or a mock. Wrappers created before keep their bus.
+    '''
+    global _bus, _manager
+    with _connect_lock:
+        _bus = bus
+        _manager = None
+
+def get_manager():
+    '''
+    Get the interface of the BlueZ manager object, looked up on first use.
+    '''
+    global _manager
+    with _connect_lock:
+        if _manager is None:
+            manager_obj = get_bus().get_object('org.bluez', '/')
+            _manager = dbus.Interface(manager_obj, 'org.bluez.Manager')
+        return _manager
 
 
 class DbusProperty(object):
@@ -21,8 +72,8 @@ class DbusProperty(object):
     the property by property name. Allows an option to set the property to 
     read-only.
     
-    It is required that classes using this property descriptor have an interface
-    attribute containing the dbus interface.
+    It is required that classes using this property descriptor derive from
+    DbusObjectWrapper. Values are read from the wrapper's property cache.
     '''
 
     def __init__(self, name, read_only=False):
@@ -30,33 +81,408 @@ class DbusProperty(object):
         self.read_only = read_only
         
     def __get__(self, instance, owner):
-        props = instance.interface.GetProperties()
-        if not self.name in props:
-            raise AttributeError("Property currently not available.")
-        return props[self.name]
+        if instance is None:
+            return self
+        return instance.get_property(self.name)
     
     def __set__(self, instance, value):
         if self.read_only:
             raise AttributeError("Property is read-only!")
-        instance.interface.SetProperty(self.name, value)
+        instance.set_property(self.name, value)
+
+
+class DbusFuture(object):
+    '''
+    Result of an asynchronous dbus call. The reply is delivered by the main
+    loop, so waiting for a result only works from another thread than the 
+    one running the main loop. In the main loop thread use callbacks.
+    '''
+    
+    def __init__(self):
+        self._done = threading.Event()
+        self._result = None
+        self._error = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+        
+    def done(self):
+        '''
+        Check whether the reply arrived.
+        '''
+        return self._done.is_set()
+    
+    def result(self, timeout=None):
+        '''
+        Wait for the reply and return it, raising the error if the call 
+        failed. Calls returning several values return a tuple.
+        '''
+        if not self._done.wait(timeout):
+            raise DbusTimeout("No reply received in time.")
+        if self._error is not None:
+            raise self._error
+        return self._result
+    
+    def exception(self, timeout=None):
+        '''
+        Wait for the reply and return the error, None on success.
+        '''
+        if not self._done.wait(timeout):
+            raise DbusTimeout("No reply received in time.")
+        return self._error
+    
+    def add_done_callback(self, callback):
+        '''
+        Call callback with the future once the reply arrived, right away if
+        it already did.
+        '''
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+        
+    def set_result(self, *values):
+        '''
+        Reply handler for dbus calls.
+        '''
+        if len(values) == 1:
+            values = values[0]
+        elif not values:
+            values = None
+        self._result = values
+        self._finish()
+        
+    def set_exception(self, error):
+        '''
+        Error handler for dbus calls.
+        '''
+        self._error = error
+        self._finish()
+        
+    def _finish(self):
+        with self._lock:
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+
+class DbusTimeout(Exception):
+    '''
+    Raised when waiting too long for a DbusFuture.
+    '''
+
+
+def as_completed(futures, timeout=None):
+    '''
+    Iterate over the futures in the order their replies arrive.
+    '''
+    arrived = Queue.Queue()
+    futures = list(futures)
+    for future in futures:
+        future.add_done_callback(arrived.put)
+    for i in range(len(futures)):
+        try:
+            yield arrived.get(timeout=timeout)
+        except Queue.Empty:
+            raise DbusTimeout("No reply received in time.")
+
+
+def wait_all(futures, timeout=None):
+    '''
+    Wait for all futures, return their results in the same order.
+    '''
+    futures = list(futures)
+    for future in as_completed(futures, timeout):
+        pass
+    return [future.result() for future in futures]
+
+
+class Snapshot(object):
+    '''
+    Immutable record of the DbusProperty values of a wrapper, taken with a
+    single GetProperties call. Properties not available are None.
+    
+    Each wrapper class gets its own Snapshot subclass having a slot per 
+    declared DbusProperty, named like the descriptor.
+    '''
+    __slots__ = ()
+    
+    def __init__(self, props):
+        for attr, prop_name in self._fields:
+            value = props.get(prop_name)
+            if isinstance(value, list):
+                value = tuple(value)
+            object.__setattr__(self, attr, value)
+    
+    def __setattr__(self, name, value):
+        raise AttributeError("Snapshot is read-only!")
+    
+    def __delattr__(self, name):
+        raise AttributeError("Snapshot is read-only!")
+    
+    def __repr__(self):
+        return "%s(%s)" % (type(self).__name__, 
+                           ", ".join("%s=%r" % (attr, getattr(self, attr)) 
+                                     for attr, prop_name in self._fields))
+    
+    def as_dict(self):
+        '''
+        Get the values as a dictionary keyed by attribute name.
+        '''
+        return dict((attr, getattr(self, attr)) 
+                    for attr, prop_name in self._fields)
+    
+    @classmethod
+    def for_class(cls, klass):
+        '''
+        Get the Snapshot subclass for a wrapper class.
+        '''
+        record = klass.__dict__.get('_snapshot_class')
+        if record is None:
+            # Walk from the root, so that subclasses override their bases
+            props = {}
+            for base in reversed(klass.__mro__):
+                for attr, value in vars(base).items():
+                    if isinstance(value, DbusProperty):
+                        props[attr] = value.name
+                    else:
+                        props.pop(attr, None)
+            fields = sorted(props.items())
+            record = type(klass.__name__ + 'Snapshot', (cls,), 
+                          {'__slots__': tuple(attr for attr, p in fields),
+                           '_fields': tuple(fields)})
+            klass._snapshot_class = record
+        return record
 
 
 class DbusObjectWrapper(object):
     '''
     Generic wrapper for Dbus objects.
+    
+    Properties are fetched with a single GetProperties call on first use and
+    cached. The cache is kept up to date from PropertyChanged signals and 
+    written through when setting a property.
+    
+    The dbus proxy object is only created when the interface is first used.
+    Signals are received from construction on.
     '''
     
-    def __init__(self, bus_name, object_path, dbus_interface):
+    def __init__(self, bus_name, object_path, dbus_interface, bus=None):
+        '''
+        Initialize the wrapper for the dbus object, by default on the bus 
+        returned by get_bus.
+        '''
+        if bus is None:
+            bus = get_bus()
+        self.bus = bus
+        self.bus_name = bus_name
+        self.object_path = object_path
+        self.dbus_interface = dbus_interface
+        self._interface = None
+        self._signal_matches = []
+        self._properties = None
+        self._properties_lock = threading.Lock()
+        self._fetches = 0           # GetProperties calls in flight
+        self._changes = {}          # PropertyChanged received meanwhile
+        self.connect_to_signal('PropertyChanged', self._property_changed)
+    
+    @property
+    def interface(self):
         '''
-        Initialize the interface to the wrapped dbus object.
+        The dbus interface of the wrapped object, created on first use.
         '''
-        obj = bus.get_object(bus_name, object_path)
-        self.interface = dbus.Interface(obj, dbus_interface)
+        interface = self._interface
+        if interface is None:
+            obj = self.bus.get_object(self.bus_name, self.object_path)
+            interface = dbus.Interface(obj, self.dbus_interface)
+            self._interface = interface
+            _count('proxies', 1)
+        return interface
+    
+    def connect_to_signal(self, signal_name, handler):
+        '''
+        Receive a signal of the wrapped object without creating the proxy.
+        '''
+        match = self.bus.add_signal_receiver(handler, 
+                                             signal_name=signal_name,
+                                             dbus_interface=self.dbus_interface,
+                                             bus_name=self.bus_name,
+                                             path=self.object_path)
+        self._signal_matches.append(match)
+        _count('signal_matches', 1)
+        return match
+    
+    def disconnect_signal(self, match):
+        '''
+        Stop receiving a signal connected with connect_to_signal.
+        '''
+        if match in self._signal_matches:
+            self._signal_matches.remove(match)
+            match.remove()
+            _count('signal_matches', -1)
+    
+    def close(self):
+        '''
+        Stop receiving signals and release the dbus proxy.
+        '''
+        matches, self._signal_matches = self._signal_matches, []
+        for match in matches:
+            match.remove()
+        _count('signal_matches', -len(matches))
+        if self._interface is not None:
+            self._interface = None
+            _count('proxies', -1)
+
+    def get_property(self, name, strict=False):
+        '''
+        Get the value of a property. Use strict to bypass the cache and read
+        the current value from dbus.
+        '''
+        if strict:
+            props = self.refresh_properties()
+        else:
+            props = self.get_properties()
+        if not name in props:
+            raise AttributeError("Property currently not available.")
+        return props[name]
+    
+    def set_property(self, name, value):
+        '''
+        Set the value of a property in dbus and in the cache.
+        '''
+        self.interface.SetProperty(name, value)
+        self._property_changed(name, value)
+        
+    def get_properties(self):
+        '''
+        Get all cached properties, fetching them if not cached yet.
+        '''
+        props = self._properties
+        if props is None:
+            props = self.refresh_properties()
+        return props
+    
+    def refresh_properties(self):
+        '''
+        Replace the cached properties with the current values from dbus.
+        '''
+        self._begin_fetch()
+        try:
+            props = dict(self.interface.GetProperties())
+        except:
+            self._end_fetch(None)
+            raise
+        return self._end_fetch(props)
+    
+    def call_async(self, method, *args, **kwargs):
+        '''
+        Call a dbus method without blocking, returns a DbusFuture. A dbus 
+        call timeout in seconds can be given as keyword timeout.
+        '''
+        future = DbusFuture()
+        kwargs['reply_handler'] = future.set_result
+        kwargs['error_handler'] = future.set_exception
+        getattr(self.interface, method)(*args, **kwargs)
+        return future
+    
+    def get_properties_async(self, strict=False):
+        '''
+        Get all properties without blocking, returns a DbusFuture. Cached 
+        properties are returned right away unless strict is used, fetched 
+        ones are stored in the cache.
+        '''
+        props = self._properties
+        if props is not None and not strict:
+            future = DbusFuture()
+            future.set_result(props)
+            return future
+        
+        future = DbusFuture()
+        def reply(props):
+            future.set_result(self._end_fetch(dict(props)))
+        def error(error):
+            self._end_fetch(None)
+            future.set_exception(error)
+        self._begin_fetch()
+        try:
+            self.interface.GetProperties(reply_handler=reply, 
+                                         error_handler=error)
+        except:
+            self._end_fetch(None)
+            raise
+        return future
+    
+    def get_property_async(self, name, strict=False):
+        '''
+        Get the value of a property without blocking, returns a DbusFuture.
+        '''
+        future = DbusFuture()
+        def reply(properties):
+            error = properties.exception()
+            if error is not None:
+                future.set_exception(error)
+            elif not name in properties.result():
+                future.set_exception(
+                    AttributeError("Property currently not available."))
+            else:
+                future.set_result(properties.result()[name])
+        self.get_properties_async(strict).add_done_callback(reply)
+        return future
+    
+    def snapshot(self, strict=False):
+        '''
+        Get an immutable record of all declared properties. Use strict to 
+        read the current values from dbus instead of the cache.
+        '''
+        if strict:
+            props = self.refresh_properties()
+        else:
+            props = self.get_properties()
+        return Snapshot.for_class(type(self))(props)
+    
+    def _property_changed(self, name, value):
+        '''
+        Update the cache, properties not fetched yet are left to the first
+        read. Changes arriving while properties are fetched are kept to be
+        applied over the reply, which may predate them.
+        '''
+        with self._properties_lock:
+            if self._fetches:
+                self._changes[name] = value
+            if self._properties is not None:
+                props = dict(self._properties)
+                props[name] = value
+                self._properties = props
+
+    def _begin_fetch(self):
+        '''
+        Start recording property changes for a GetProperties call.
+        '''
+        with self._properties_lock:
+            self._fetches += 1
+
+    def _end_fetch(self, props):
+        '''
+        Store the properties a GetProperties call returned, None if it 
+        failed, with the changes received meanwhile applied over them.
+        Returns the stored properties.
+        '''
+        with self._properties_lock:
+            self._fetches -= 1
+            if props is not None:
+                props.update(self._changes)
+                self._properties = props
+            if not self._fetches:
+                self._changes = {}
+        return props
 
     def __getattr__(self, name):
         '''
         For unknown attributes try to relay to dbus methods.
         '''
+        if name.startswith('_'):
+            raise AttributeError(name)
         return getattr(self.interface, name)
     
 
@@ -66,13 +492,14 @@ class Device(DbusObjectWrapper):
     Wrapper for a bluetooth device connected to the bluetooth adapter.
     '''
     
-    def __init__(self, object_path):
+    def __init__(self, object_path, bus=None):
         '''
         Initialize for the bt device at the given object path.
         '''
         super(Device, self).__init__('org.bluez', 
                                      object_path, 
-                                     'org.bluez.Device')
+                                     'org.bluez.Device',
+                                     bus)
     
     address = DbusProperty('Address', read_only=True)
     name = DbusProperty('Name', read_only=True)
@@ -98,17 +525,19 @@ class Adapter(DbusObjectWrapper):
     Wrapper for a bluetooth adapter.
     '''
     
-    def __init__(self, object_path):
+    def __init__(self, object_path, bus=None):
         '''
         Initialize for the hci device at the given object path.
         '''
         super(Adapter, self).__init__('org.bluez', 
                                       object_path, 
-                                      'org.bluez.Adapter')
-        self.interface.connect_to_signal('DeviceFound', self.__device_found)
-        self.interface.connect_to_signal('DeviceDisappeared', self.__device_disappeared)
-        self.interface.connect_to_signal('DeviceCreated', self.__device_created)
-        self.interface.connect_to_signal('DeviceRemoved', self.__device_removed)
+                                      'org.bluez.Adapter',
+                                      bus)
+        self.registry = DeviceRegistry()
+        self.connect_to_signal('DeviceFound', self.__device_found)
+        self.connect_to_signal('DeviceDisappeared', self.__device_disappeared)
+        self.connect_to_signal('DeviceCreated', self.__device_created)
+        self.connect_to_signal('DeviceRemoved', self.__device_removed)
         
     address = DbusProperty('Address', read_only=True)
     name = DbusProperty('Name', read_only=False)
@@ -130,38 +559,810 @@ class Adapter(DbusObjectWrapper):
         '''
         Get all devices associated with this adapter.
         '''
-        return get_objects_from_property(Device, self.interface, 'Devices')
+        return get_objects_from_property(Device, self.interface, 'Devices',
+                                         self.bus)
     
     def __device_found(self, address, values):
-        print("device_found: %s (%s)" % (address, values))
+        if tracer.enabled:
+            tracer.trace('DeviceFound', self.object_path, address, values)
+        self.registry.found(address, values)
         self.device_found(address, values)
         
     def __device_disappeared(self, address):
-        pass
+        if tracer.enabled:
+            tracer.trace('DeviceDisappeared', self.object_path, address)
+        self.registry.disappeared(address)
+        self.device_disappeared(address)
     
     def __device_created(self, device):
-        pass
+        if tracer.enabled:
+            tracer.trace('DeviceCreated', self.object_path, device)
+        self.registry.created(device)
+        self.device_created(device)
     
     def __device_removed(self, device):
-        pass
+        if tracer.enabled:
+            tracer.trace('DeviceRemoved', self.object_path, device)
+        forget_wrapper(device, self.bus)
+        self.registry.removed(device)
+        self.device_removed(device)
+
+class SignalTracer(object):
+    '''
+    Keeps the most recent signals handled by the wrappers in a ring buffer,
+    to be inspected on demand. Disabled by default. Each signal type can be
+    sampled, keeping one of every n signals, and rate limited to a number 
+    of signals per second. Signals are only formatted when dumped.
+    
+    from btsec.btdbus import tracer
+    tracer.limit('DeviceFound', sample=10, rate=5)
+    tracer.enable()
+    ...
+    tracer.dump()
+    '''
+    
+    def __init__(self, size=1000):
+        self.enabled = False
+        self.events = collections.deque(maxlen=size)
+        self._limits = {}       # signal: [sample, rate, seen, tokens, time]
+        self._dropped = collections.defaultdict(int)
+        self._lock = threading.Lock()
+        
+    def enable(self, size=None):
+        '''
+        Start tracing, optionally changing the ring buffer size.
+        '''
+        if size is not None and size != self.events.maxlen:
+            self.events = collections.deque(self.events, maxlen=size)
+        self.enabled = True
+        
+    def disable(self):
+        '''
+        Stop tracing, the recorded signals are kept.
+        '''
+        self.enabled = False
+        
+    def limit(self, signal, sample=1, rate=None):
+        '''
+        Trace only one of every sample signals of this type, and at most 
+        rate of them per second if rate is given.
+        '''
+        if sample < 1:
+            raise ValueError("Sample must be at least 1.")
+        if rate is not None and rate <= 0:
+            raise ValueError("Rate must be positive.")
+        with self._lock:
+            self._limits[signal] = [sample, rate, 0, rate, time.time()]
+    
+    def trace(self, signal, path, *args):
+        '''
+        Record a signal received for the object at path, unless dropped by 
+        the limits of its type.
+        '''
+        if not self.enabled:
+            return
+        now = time.time()
+        with self._lock:
+            limit = self._limits.get(signal)
+            if limit is not None:
+                sample, rate, seen, tokens, last = limit
+                limit[2] = seen + 1
+                if seen % sample:
+                    self._dropped[signal] += 1
+                    return
+                if rate is not None:
+                    tokens = min(rate, tokens + (now - last) * rate)
+                    limit[4] = now
+                    if tokens < 1:
+                        limit[3] = tokens
+                        self._dropped[signal] += 1
+                        return
+                    limit[3] = tokens - 1
+            self.events.append((now, signal, path, args))
+    
+    def recent(self, count=None, signal=None):
+        '''
+        Get the recorded signals, oldest first, as tuples of 
+        (time, signal, object path, arguments).
+        '''
+        with self._lock:
+            events = list(self.events)
+        if signal is not None:
+            events = [e for e in events if e[1] == signal]
+        if count is not None:
+            events = events[-count:]
+        return events
+    
+    def dropped(self):
+        '''
+        Get the number of signals dropped by the limits, per signal type.
+        '''
+        with self._lock:
+            return dict(self._dropped)
+    
+    def dump(self, count=None, signal=None, out=None):
+        '''
+        Write the recorded signals to out, sys.__stderr__ by default so 
+        that consoles capturing stdout are bypassed.
+        '''
+        out = out or sys.__stderr__
+        for when, signal_, path, args in self.recent(count, signal):
+            out.write("%s.%03d %s %s %s\n" % (
+                time.strftime('%H:%M:%S', time.localtime(when)), 
+                int(when * 1000) % 1000, signal_, path, 
+                " ".join(repr(a) for a in args)))
+    
+    def clear(self):
+        '''
+        Discard the recorded signals and the dropped counters.
+        '''
+        with self._lock:
+            self.events.clear()
+            self._dropped.clear()
+
+
+# Tracer for the signals handled by all wrappers
+tracer = SignalTracer()
+
+
+class DeviceRecord(object):
+    '''
+    Latest known state of a device seen by an adapter.
+    '''
+    __slots__ = ('address', 'device_class', 'rssi', 'values', 'object_path',
+                 'first_seen', 'last_seen', 'sightings')
+    
+    def __init__(self, address):
+        self.address = address
+        self.device_class = None
+        self.rssi = None
+        self.values = {}
+        self.object_path = None
+        self.first_seen = None
+        self.last_seen = None
+        self.sightings = 0
+        
+    def __repr__(self):
+        return "DeviceRecord(%s, class=%s, rssi=%s)" % (self.address, 
+                                                        self.device_class, 
+                                                        self.rssi)
+
+
+class DeviceRegistry(object):
+    '''
+    Devices currently present around an adapter, updated from its discovery
+    signals without querying BlueZ. Devices are indexed by address, class 
+    and RSSI. Lookups by address take constant time, RSSI queries scan at 
+    most one bucket per dBm.
+    
+    Handlers of the events receive the DeviceRecord, device_lost receives
+    the last record of the device.
+    '''
+    
+    def __init__(self):
+        self._devices = {}      # address: DeviceRecord
+        self._classes = {}      # device class: set of addresses
+        self._rssi = {}         # rssi: set of addresses
+        self._paths = {}        # address: object path of created devices
+        self._lock = threading.RLock()
+        
+        self.device_added = Event()
+        self.device_updated = Event()
+        self.device_lost = Event()
+    
+    def get(self, address):
+        '''
+        Get the record of a present device, None if not present.
+        '''
+        return self._devices.get(address)
+    
+    def addresses(self):
+        '''
+        Get the addresses of all present devices.
+        '''
+        with self._lock:
+            return list(self._devices)
+    
+    def records(self):
+        '''
+        Get the records of all present devices.
+        '''
+        with self._lock:
+            return list(self._devices.values())
+    
+    def by_class(self, device_class):
+        '''
+        Get the records of present devices having the given class.
+        '''
+        with self._lock:
+            return [self._devices[a] 
+                    for a in self._classes.get(device_class, ())]
+    
+    def by_rssi(self, min_rssi, max_rssi=None):
+        '''
+        Get the records of present devices having min_rssi <= RSSI, and 
+        RSSI <= max_rssi if given, strongest first.
+        '''
+        with self._lock:
+            levels = sorted((rssi for rssi in self._rssi 
+                             if rssi >= min_rssi and 
+                             (max_rssi is None or rssi <= max_rssi)), 
+                            reverse=True)
+            return [self._devices[a] for rssi in levels 
+                    for a in self._rssi[rssi]]
+    
+    def strongest(self, count=1):
+        '''
+        Get the records of the count devices received best.
+        '''
+        with self._lock:
+            res = []
+            for rssi in sorted(self._rssi, reverse=True):
+                for address in self._rssi[rssi]:
+                    if len(res) == count:
+                        return res
+                    res.append(self._devices[address])
+            return res
+    
+    def __len__(self):
+        return len(self._devices)
+    
+    def __contains__(self, address):
+        return address in self._devices
+    
+    def __iter__(self):
+        return iter(self.records())
+    
+    def found(self, address, values):
+        '''
+        Handle a DeviceFound signal.
+        '''
+        now = time.time()
+        with self._lock:
+            record = self._devices.get(address)
+            added = record is None
+            if added:
+                record = self._devices[address] = DeviceRecord(address)
+                record.first_seen = now
+                record.object_path = self._paths.get(address)
+            
+            device_class = values.get('Class', record.device_class)
+            if device_class != record.device_class or added:
+                self._discard(self._classes, record.device_class, address)
+                self._classes.setdefault(device_class, set()).add(address)
+                record.device_class = device_class
+            
+            rssi = values.get('RSSI', record.rssi)
+            if rssi != record.rssi or added:
+                self._discard(self._rssi, record.rssi, address)
+                self._rssi.setdefault(rssi, set()).add(address)
+                record.rssi = rssi
+                
+            if added:
+                record.values = dict(values)
+            else:
+                record.values.update(values)
+            record.last_seen = now
+            record.sightings += 1
+            
+        if added:
+            self.device_added(record)
+        else:
+            self.device_updated(record)
+    
+    def disappeared(self, address):
+        '''
+        Handle a DeviceDisappeared signal.
+        '''
+        with self._lock:
+            record = self._devices.pop(address, None)
+            if record is None:
+                return
+            self._discard(self._classes, record.device_class, address)
+            self._discard(self._rssi, record.rssi, address)
+        self.device_lost(record)
+    
+    def created(self, object_path):
+        '''
+        Handle a DeviceCreated signal.
+        '''
+        address = _address_from_path(object_path)
+        with self._lock:
+            self._paths[address] = object_path
+            record = self._devices.get(address)
+            if record is not None:
+                record.object_path = object_path
+        if record is not None:
+            self.device_updated(record)
+    
+    def removed(self, object_path):
+        '''
+        Handle a DeviceRemoved signal.
+        '''
+        address = _address_from_path(object_path)
+        with self._lock:
+            self._paths.pop(address, None)
+            record = self._devices.get(address)
+            if record is not None:
+                record.object_path = None
+        if record is not None:
+            self.device_updated(record)
+    
+    def clear(self):
+        '''
+        Forget all present devices.
+        '''
+        with self._lock:
+            self._devices.clear()
+            self._classes.clear()
+            self._rssi.clear()
+    
+    def _discard(self, index, key, address):
+        addresses = index.get(key)
+        if addresses is not None:
+            addresses.discard(address)
+            if not addresses:
+                del index[key]
+
+
+class RssiSeries(object):
+    '''
+    Time series of the RSSI of a device, stored in arrays. Once max_samples
+    is reached the older half of the series is downsampled, keeping the 
+    strongest of every two samples, so memory stays bounded while recent 
+    samples keep full resolution.
+    '''
+    __slots__ = ('times', 'values', 'max_samples', 'max_rssi')
+    
+    def __init__(self, max_samples=1024):
+        self.times = array.array('d')
+        self.values = array.array('h')
+        self.max_samples = max_samples
+        self.max_rssi = None
+        
+    def __len__(self):
+        return len(self.times)
+    
+    @property
+    def last_seen(self):
+        return self.times[-1] if self.times else None
+        
+    def add(self, when, rssi):
+        '''
+        Append a sample, samples are expected in chronological order.
+        '''
+        self.times.append(when)
+        self.values.append(rssi)
+        if self.max_rssi is None or rssi > self.max_rssi:
+            self.max_rssi = rssi
+        if len(self.times) >= self.max_samples:
+            self._downsample()
+            
+    def strongest(self, since=None):
+        '''
+        Get the highest RSSI, of the samples taken since a time if given.
+        '''
+        if since is None:
+            return self.max_rssi
+        start = bisect.bisect_left(self.times, since)
+        if start == len(self.times):
+            return None
+        return max(self.values[start:])
+    
+    def samples(self, since=None):
+        '''
+        Get the samples as a list of (time, rssi).
+        '''
+        start = 0
+        if since is not None:
+            start = bisect.bisect_left(self.times, since)
+        return list(zip(self.times[start:], self.values[start:]))
+        
+    def _downsample(self):
+        half = (len(self.times) // 4) * 2
+        times = array.array('d')
+        values = array.array('h')
+        for i in range(0, half, 2):
+            if self.values[i] >= self.values[i + 1]:
+                times.append(self.times[i])
+                values.append(self.values[i])
+            else:
+                times.append(self.times[i + 1])
+                values.append(self.values[i + 1])
+        times.extend(self.times[half:])
+        values.extend(self.values[half:])
+        self.times = times
+        self.values = values
+
+
+class DiscoverySession(object):
+    '''
+    Runs discovery on an adapter and records every sighting of a device, 
+    with its RSSI, into an RssiSeries per device address.
+    
+    session = DiscoverySession(adapter)
+    session.start()
+    ...
+    session.seen_since(time.time() - 60)
+    session.strongest()
+    session.stop()
+    '''
+    
+    def __init__(self, adapter, max_samples=1024):
+        self.adapter = adapter
+        self.max_samples = max_samples
+        self.started = None
+        self._series = {}       # address: RssiSeries
+        self._match = None
+        self._lock = threading.Lock()
+        
+    def start(self):
+        '''
+        Start recording and start discovery on the adapter.
+        '''
+        if self._match is None:
+            self._match = self.adapter.connect_to_signal('DeviceFound', 
+                                                         self.record)
+            self.started = time.time()
+            self.adapter.StartDiscovery()
+        
+    def stop(self):
+        '''
+        Stop discovery on the adapter and stop recording. Recorded series 
+        are kept.
+        '''
+        if self._match is not None:
+            self.adapter.disconnect_signal(self._match)
+            self._match = None
+            self.adapter.StopDiscovery()
+            
+    def record(self, address, values, when=None):
+        '''
+        Record a sighting, called for every DeviceFound signal.
+        '''
+        rssi = values.get('RSSI')
+        if rssi is None:
+            return
+        if when is None:
+            when = time.time()
+        with self._lock:
+            series = self._series.get(address)
+            if series is None:
+                series = self._series[address] = RssiSeries(self.max_samples)
+            series.add(when, int(rssi))
+        
+    def addresses(self):
+        '''
+        Get the addresses of all devices seen during the session.
+        '''
+        with self._lock:
+            return list(self._series)
+        
+    def series(self, address):
+        '''
+        Get the RssiSeries of a device, None if never seen.
+        '''
+        return self._series.get(address)
+    
+    def seen_since(self, since):
+        '''
+        Get the addresses of the devices seen since a time.
+        '''
+        with self._lock:
+            return [address for address, series in self._series.items()
+                    if series.times[-1] >= since]
+    
+    def strongest(self, since=None):
+        '''
+        Get the highest RSSI per device address, of the samples taken since
+        a time if given. Devices not seen since then are left out.
+        '''
+        res = {}
+        with self._lock:
+            for address, series in self._series.items():
+                if since is not None and series.times[-1] < since:
+                    continue
+                res[address] = series.strongest(since)
+        return res
+    
+    def clear(self):
+        '''
+        Discard all recorded series.
+        '''
+        with self._lock:
+            self._series.clear()
+
+
+class ScanCoordinator(object):
+    '''
+    Runs discovery on several adapters and merges their DeviceFound signals
+    by device address, keeping track of the adapter receiving each device 
+    best.
+    
+    At most concurrent adapters discover at the same time, all by default.
+    With fewer, discovery rotates over the adapters every window seconds so
+    that each adapter gets its turn.
+    
+    device_found fires once per address with (address, values, adapter), 
+    best_adapter_changed fires with (address, adapter) when another adapter
+    starts receiving a device better.
+    '''
+    
+    def __init__(self, adapters=None, concurrent=None, window=10.0):
+        if adapters is None:
+            adapters = get_adapters()
+        self.adapters = list(adapters)
+        self.concurrent = concurrent or len(self.adapters)
+        self.window = window
+        
+        self.device_found = Event()
+        self.best_adapter_changed = Event()
+        
+        self._rssi = {}         # address: {adapter path: latest rssi}
+        self._best = {}         # address: adapter path
+        self._stats = {}        # adapter path: counters, see stats
+        self._matches = {}      # adapter path: signal match
+        self._active = []       # adapters currently discovering
+        self._next = 0          # index of the next adapter to activate
+        self._timer = None
+        self._lock = threading.RLock()
+        
+    def start(self):
+        '''
+        Start discovery on the first adapters and start merging signals.
+        '''
+        with self._lock:
+            if self._matches:
+                return
+            for adapter in self.adapters:
+                path = adapter.object_path
+                self._stats.setdefault(path, {'sightings': 0, 
+                                              'devices': set(),
+                                              'active_time': 0.0,
+                                              'since': None})
+                self._matches[path] = adapter.connect_to_signal(
+                    'DeviceFound', 
+                    lambda address, values, adapter=adapter: 
+                        self.record(adapter, address, values))
+            self._rotate()
+            
+    def stop(self):
+        '''
+        Stop discovery on all adapters and stop merging signals. The merged
+        devices and statistics are kept.
+        '''
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            for adapter in self._active:
+                self._deactivate(adapter)
+            self._active = []
+            for adapter in self.adapters:
+                match = self._matches.pop(adapter.object_path, None)
+                if match is not None:
+                    adapter.disconnect_signal(match)
+    
+    def record(self, adapter, address, values):
+        '''
+        Merge a DeviceFound signal received by an adapter.
+        '''
+        path = adapter.object_path
+        rssi = values.get('RSSI')
+        with self._lock:
+            stats = self._stats[path]
+            stats['sightings'] += 1
+            stats['devices'].add(address)
+            
+            levels = self._rssi.get(address)
+            new = levels is None
+            if new:
+                levels = self._rssi[address] = {}
+            if rssi is not None:
+                levels[path] = rssi
+            
+            best = self._best.get(address)
+            if best is None or (best != path and rssi is not None and 
+                                rssi > levels.get(best, rssi - 1)):
+                self._best[address] = best = path
+                changed = not new
+            else:
+                changed = False
+        
+        if new:
+            self.device_found(address, values, adapter)
+        elif changed:
+            self.best_adapter_changed(address, adapter)
+            
+    def best_adapter(self, address):
+        '''
+        Get the object path of the adapter receiving a device best.
+        '''
+        return self._best.get(address)
+    
+    def devices(self):
+        '''
+        Get the merged devices as a dictionary of address to a tuple of 
+        (best adapter path, its latest RSSI).
+        '''
+        with self._lock:
+            return dict((address, (path, self._rssi[address].get(path)))
+                        for address, path in self._best.items())
+    
+    def stats(self):
+        '''
+        Get the statistics per adapter path: DeviceFound signals received, 
+        distinct devices, seconds spent discovering, signals per second of
+        discovery and the number of devices the adapter receives best.
+        '''
+        now = time.time()
+        with self._lock:
+            best_for = collections.defaultdict(int)
+            for path in self._best.values():
+                best_for[path] += 1
+            res = {}
+            for path, stats in self._stats.items():
+                active = stats['active_time']
+                if stats['since'] is not None:
+                    active += now - stats['since']
+                res[path] = {'sightings': stats['sightings'],
+                             'devices': len(stats['devices']),
+                             'active_time': active,
+                             'rate': stats['sightings'] / active if active 
+                                     else 0.0,
+                             'best_for': best_for[path]}
+            return res
+    
+    def _rotate(self):
+        '''
+        Hand discovery over to the next adapters, rescheduling itself while
+        not all adapters can discover at once.
+        '''
+        with self._lock:
+            if not self._matches:
+                return
+            count = len(self.adapters)
+            selected = [self.adapters[(self._next + i) % count] 
+                        for i in range(min(self.concurrent, count))]
+            self._next = (self._next + len(selected)) % count
+            
+            for adapter in self._active:
+                if adapter not in selected:
+                    self._deactivate(adapter)
+            for adapter in selected:
+                if adapter not in self._active:
+                    self._activate(adapter)
+            self._active = selected
+            
+            if self.concurrent < count:
+                self._timer = threading.Timer(self.window, self._rotate)
+                self._timer.daemon = True
+                self._timer.start()
+    
+    def _activate(self, adapter):
+        adapter.StartDiscovery()
+        self._stats[adapter.object_path]['since'] = time.time()
+        
+    def _deactivate(self, adapter):
+        adapter.StopDiscovery()
+        stats = self._stats[adapter.object_path]
+        if stats['since'] is not None:
+            stats['active_time'] += time.time() - stats['since']
+            stats['since'] = None
+
+
+def _address_from_path(object_path):
+    '''
+    Get the device address from a BlueZ device object path, which ends in 
+    dev_XX_XX_XX_XX_XX_XX.
+    '''
+    name = object_path.rsplit('/', 1)[-1]
+    if name.startswith('dev_'):
+        name = name[4:]
+    return name.replace('_', ':')
+
 
 def get_adapters():
     '''
     Retrieve all connected bluetooth adapters
     '''
-    return get_objects_from_property(Adapter, manager, 'Adapters')
+    return get_objects_from_property(Adapter, get_manager(), 'Adapters', 
+                                     get_bus())
 
-def get_objects_from_property(klass, interface, prop_name):
+def snapshot_devices(adapters=None, timeout=None):
     '''
-    Construct instances of wrapper objects from dbus.
-    The klass constructor is expected to only require a dbus object path.
+    Take a snapshot of every device of the given adapters, all adapters by
+    default. The GetProperties calls are all issued at once on the bus
+    connection and their replies awaited together, so like DbusFuture this
+    only works from another thread than the one running the main loop.
+    Returns a dictionary of device snapshots keyed by object path.
+    '''
+    if adapters is None:
+        adapters = get_adapters()
+    devices = []
+    for adapter in adapters:
+        devices.extend(adapter.get_devices())
+    
+    futures = [device.get_properties_async(strict=True) for device in devices]
+    snapshots = {}
+    for device, props in zip(devices, wait_all(futures, timeout)):
+        snapshots[device.object_path] = \
+            Snapshot.for_class(type(device))(props)
+    return snapshots
+
+def get_objects_from_property(klass, interface, prop_name, bus=None):
+    '''
+    Get the wrapper objects for the object paths in a dbus property, see 
+    get_wrapper.
     '''
     props = interface.GetProperties()
     paths = props[prop_name]
     res = []
     for path in paths:
-        res.append(klass(path))
+        res.append(get_wrapper(klass, path, bus))
     return res
 
+def get_wrapper(klass, object_path, bus=None):
+    '''
+    Get the wrapper for an object path, constructing it on first use. The 
+    same wrapper is returned for a path until the object is removed from 
+    BlueZ. The klass constructor is expected to only require a dbus object 
+    path and to accept the bus as an optional second argument.
+    '''
+    if bus is None:
+        bus = get_bus()
+    with _wrappers_lock:
+        wrappers = _wrappers.get(bus)
+        if wrappers is None:
+            wrappers = _wrappers[bus] = {}
+            _removal_matches[bus] = bus.add_signal_receiver(
+                lambda path: forget_wrapper(path, bus),
+                signal_name='AdapterRemoved',
+                dbus_interface='org.bluez.Manager',
+                bus_name='org.bluez',
+                path='/')
+            _count('signal_matches', 1)
+        wrapper = wrappers.get(object_path)
+        if wrapper is None:
+            wrapper = wrappers[object_path] = klass(object_path, bus)
+        return wrapper
+
+def forget_wrapper(object_path, bus=None):
+    '''
+    Close and drop the wrapper for an object path and for the objects below
+    it, e.g. the devices of an adapter. Once no wrapper is left for the bus,
+    the bus itself is released.
+    '''
+    if bus is None:
+        bus = get_bus()
+    prefix = object_path + '/'
+    with _wrappers_lock:
+        wrappers = _wrappers.get(bus)
+        if wrappers is None:
+            return
+        for path in list(wrappers):
+            if path == object_path or path.startswith(prefix):
+                wrappers.pop(path).close()
+        if not wrappers:
+            del _wrappers[bus]
+            _removal_matches.pop(bus).remove()
+            _count('signal_matches', -1)
+
+def connection_stats():
+    '''
+    Get the number of wrappers in the identity map and the number of dbus 
+    proxies and signal matches held by all wrappers.
+    '''
+    with _wrappers_lock:
+        wrappers = sum(len(w) for w in _wrappers.values())
+    with _counters_lock:
+        stats = dict(_counters)
+    stats['wrappers'] = wrappers
+    return stats
+
+def _count(counter, delta):
+    with _counters_lock:
+        _counters[counter] += delta
+
 if __name__ == "__main__":
     print("Test")
\ No newline at end of file
@@ -0,0 +1,341 @@
+'''
+Record and replay of the dbus traffic of btdbus, to run and measure the
+wrappers without a BlueZ daemon or Bluetooth hardware.
+
+Record a session against the real bus:
+
+    from btsec import btdbus, dbusreplay
+    recorder = dbusreplay.RecordingBus(btdbus.get_bus(), 'session.jsonl')
+    btdbus.set_bus(recorder)
+    ...
+    recorder.close()
+
+Replay it later:
+
+    bus = dbusreplay.FakeBus.load('session.jsonl')
+    btdbus.set_bus(bus)
+    adapters = btdbus.get_adapters()
+    bus.replay_signals()
+
+'''
+
+import json
+import threading
+import time
+
+import dbus
+
+
+def plain(value):
+    '''
+    Convert dbus typed values to plain python values that can be stored as
+    json.
+    '''
+    if isinstance(value, dbus.Boolean):
+        return bool(value)
+    if isinstance(value, (int, long, float)):
+        return value
+    if isinstance(value, basestring):
+        return unicode(value)
+    if isinstance(value, dict):
+        return dict((plain(k), plain(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return [plain(v) for v in value]
+    return value
+
+
+class RecordingBus(object):
+    '''
+    Wraps a bus and writes every method call made through its objects and
+    every signal received by its signal receivers to a file, one json
+    record per line.
+    '''
+
+    def __init__(self, bus, filename):
+        self.bus = bus
+        self._out = open(filename, 'w')
+        self._lock = threading.Lock()
+
+    def get_object(self, bus_name, object_path, **kwargs):
+        obj = self.bus.get_object(bus_name, object_path, **kwargs)
+        return _RecordingObject(self, obj, object_path)
+
+    def add_signal_receiver(self, handler, signal_name=None,
+                            dbus_interface=None, bus_name=None, path=None,
+                            **kwargs):
+        def record(*args):
+            self.write({'type': 'signal', 'time': time.time(), 'path': path,
+                        'interface': dbus_interface, 'signal': signal_name,
+                        'args': plain(args)})
+            return handler(*args)
+        return self.bus.add_signal_receiver(record, signal_name,
+                                            dbus_interface, bus_name, path,
+                                            **kwargs)
+
+    def write(self, record):
+        with self._lock:
+            self._out.write(json.dumps(record) + '\n')
+
+    def close(self):
+        with self._lock:
+            self._out.close()
+
+    def __getattr__(self, name):
+        return getattr(self.bus, name)
+
+
+class _RecordingObject(object):
+    '''
+    Proxy object recording the method calls made through it.
+    '''
+
+    def __init__(self, recorder, obj, object_path):
+        self._recorder = recorder
+        self._obj = obj
+        self._path = object_path
+
+    def get_dbus_method(self, member, dbus_interface=None):
+        method = self._obj.get_dbus_method(member, dbus_interface)
+
+        def call(*args, **kwargs):
+            record = {'type': 'call', 'path': self._path,
+                      'interface': dbus_interface, 'method': member,
+                      'args': plain(args)}
+            reply_handler = kwargs.pop('reply_handler', None)
+            error_handler = kwargs.pop('error_handler', None)
+            if reply_handler is None:
+                result = method(*args, **kwargs)
+                record['result'] = plain(result)
+                self._recorder.write(record)
+                return result
+
+            def reply(*values):
+                if len(values) == 1:
+                    record['result'] = plain(values[0])
+                else:
+                    record['result'] = plain(values) if values else None
+                self._recorder.write(record)
+                reply_handler(*values)
+            return method(*args, reply_handler=reply,
+                          error_handler=error_handler, **kwargs)
+        return call
+
+    def connect_to_signal(self, signal_name, handler, dbus_interface=None,
+                          **kwargs):
+        return self._recorder.add_signal_receiver(
+            handler, signal_name, dbus_interface, None, self._path, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._obj, name)
+
+
+class FakeBus(object):
+    '''
+    In-process stand-in for a bus serving BlueZ objects. Objects hold
+    properties per interface; GetProperties and SetProperty are answered
+    from them, other methods from recorded or configured results. Signals
+    are delivered synchronously by emit.
+    '''
+
+    def __init__(self):
+        self.objects = {}       # path: {interface: {property: value}}
+        self.results = {}       # (path, interface, method): [result, ...]
+        self.signals = []       # recorded signal records to replay
+        self.calls = 0
+        self._receivers = {}    # (path, interface, signal): [FakeMatch]
+        self._lock = threading.RLock()
+
+    @classmethod
+    def load(cls, filename):
+        '''
+        Build a bus from a file written by RecordingBus.
+        '''
+        bus = cls()
+        with open(filename) as recording:
+            for line in recording:
+                record = json.loads(line)
+                if record['type'] == 'signal':
+                    bus.signals.append(record)
+                elif record['method'] == 'GetProperties':
+                    bus.add_object(record['path'], record['interface'],
+                                   record['result'])
+                else:
+                    key = (record['path'], record['interface'],
+                           record['method'])
+                    bus.results.setdefault(key, []).append(record['result'])
+        return bus
+
+    def add_object(self, object_path, interface, properties=None):
+        '''
+        Add an object, or an interface to an existing object.
+        '''
+        with self._lock:
+            interfaces = self.objects.setdefault(object_path, {})
+            interfaces.setdefault(interface, {}).update(properties or {})
+
+    def set_result(self, object_path, interface, method, result):
+        '''
+        Answer all calls of a method with the given result.
+        '''
+        self.results[(object_path, interface, method)] = [result]
+
+    def get_object(self, bus_name, object_path, **kwargs):
+        if object_path not in self.objects:
+            raise dbus.DBusException("Unknown object %s" % object_path)
+        return _FakeObject(self, object_path)
+
+    def add_signal_receiver(self, handler, signal_name=None,
+                            dbus_interface=None, bus_name=None, path=None,
+                            **kwargs):
+        match = _FakeMatch(self, (path, dbus_interface, signal_name),
+                           handler)
+        with self._lock:
+            self._receivers.setdefault(match.key, []).append(match)
+        return match
+
+    def receivers(self):
+        '''
+        Number of connected signal receivers.
+        '''
+        with self._lock:
+            return sum(len(m) for m in self._receivers.values())
+
+    def emit(self, object_path, interface, signal_name, *args):
+        '''
+        Deliver a signal to the receivers matching it.
+        '''
+        handlers = []
+        with self._lock:
+            for key in ((object_path, interface, signal_name),
+                        (None, interface, signal_name),
+                        (object_path, interface, None)):
+                handlers.extend(m.handler for m in self._receivers.get(key, ()))
+        for handler in handlers:
+            handler(*args)
+
+    def replay_signals(self, speed=None):
+        '''
+        Emit the recorded signals in order. With a speed, the recorded
+        delays are kept, divided by speed; otherwise they are emitted at once.
+        Returns the number of signals emitted.
+        '''
+        previous = None
+        for record in self.signals:
+            if speed and previous is not None:
+                time.sleep(max(0, record['time'] - previous) / speed)
+            previous = record['time']
+            self.emit(record['path'], record['interface'], record['signal'],
+                      *record['args'])
+        return len(self.signals)
+
+    def call(self, object_path, interface, method, args):
+        '''
+        Answer a method call made through a fake object.
+        '''
+        self.calls += 1
+        properties = self.objects[object_path].get(interface)
+        if method == 'GetProperties' and properties is not None:
+            return dict(properties)
+        if method == 'SetProperty' and properties is not None:
+            name, value = args
+            properties[name] = value
+            self.emit(object_path, interface, 'PropertyChanged', name, value)
+            return None
+        results = self.results.get((object_path, interface, method))
+        if not results:
+            return None
+        if len(results) > 1:
+            return results.pop(0)
+        return results[0]
+
+
+class _FakeObject(object):
+    '''
+    Proxy object of a FakeBus, usable with dbus.Interface.
+    '''
+
+    def __init__(self, bus, object_path):
+        self._bus = bus
+        self._path = object_path
+
+    def get_dbus_method(self, member, dbus_interface=None):
+        def call(*args, **kwargs):
+            reply_handler = kwargs.get('reply_handler')
+            error_handler = kwargs.get('error_handler')
+            try:
+                result = self._bus.call(self._path, dbus_interface, member,
+                                        args)
+            except Exception as error:
+                if error_handler is None:
+                    raise
+                error_handler(error)
+                return
+            if reply_handler is None:
+                return result
+            if result is None:
+                reply_handler()
+            else:
+                reply_handler(result)
+        return call
+
+    def connect_to_signal(self, signal_name, handler, dbus_interface=None,
+                          **kwargs):
+        return self._bus.add_signal_receiver(handler, signal_name,
+                                             dbus_interface, None, self._path)
+
+
+class _FakeMatch(object):
+    '''
+    Signal match of a FakeBus.
+    '''
+
+    def __init__(self, bus, key, handler):
+        self.bus = bus
+        self.key = key
+        self.handler = handler
+
+    def remove(self):
+        with self.bus._lock:
+            matches = self.bus._receivers.get(self.key, [])
+            if self in matches:
+                matches.remove(self)
+
+
+def synthetic_fleet(devices, adapters=1):
+    '''
+    Build a FakeBus with a BlueZ manager, the given number of adapters and
+    devices spread over them, having the properties BlueZ 4 reports.
+    '''
+    bus = FakeBus()
+    adapter_paths = ['/org/bluez/1/hci%d' % i for i in range(adapters)]
+    bus.add_object('/', 'org.bluez.Manager', {'Adapters': adapter_paths})
+    devices_per_adapter = dict((path, []) for path in adapter_paths)
+    for i in range(devices):
+        adapter_path = adapter_paths[i % adapters]
+        address = fleet_address(i)
+        path = '%s/dev_%s' % (adapter_path, address.replace(':', '_'))
+        devices_per_adapter[adapter_path].append(path)
+        bus.add_object(path, 'org.bluez.Device', {
+            'Address': address, 'Name': 'device-%d' % i,
+            'Alias': 'device-%d' % i, 'Class': 0x5a020c,
+            'Icon': 'phone', 'Vendor': 0, 'Product': 0, 'Version': 0,
+            'UUIDs': ['00001101-0000-1000-8000-00805f9b34fb'],
+            'Services': [], 'Paired': i % 2 == 0, 'Connected': False,
+            'Trusted': False, 'Blocked': False, 'LegacyPairing': False,
+            'Nodes': [], 'Adapter': adapter_path})
+    for i, adapter_path in enumerate(adapter_paths):
+        bus.add_object(adapter_path, 'org.bluez.Adapter', {
+            'Address': '00:1A:7D:DA:71:%02X' % i, 'Name': 'hci%d' % i,
+            'Class': 0x4a010c, 'Powered': True, 'Discoverable': False,
+            'Pairable': True, 'PairableTimeout': 0,
+            'DiscoverableTimeout': 180, 'Discovering': False,
+            'Devices': devices_per_adapter[adapter_path], 'UUIDs': []})
+    return bus
+
+
+def fleet_address(index):
+    '''
+    Address of the device with the given index in a synthetic fleet.
+    '''
+    return '00:11:22:%02X:%02X:%02X' % ((index >> 16) & 0xff,
+                                        (index >> 8) & 0xff, index & 0xff)
@@ -1,26 +1,49 @@
 import __builtin__
 import __main__
+import bisect
 import codeop
+import collections
+import ctypes
 import keyword
+import os
 import re
+import resource
 import threading
+import time
 import traceback
 import sys
 if sys.version[0] == '2':
     import pygtk
     pygtk.require("2.0")
+import gobject
 import gtk
 
 from axel import Event
 
 
 class Completer:
+    """Completes names and attributes for the interpreter.
+    Names are kept sorted, so the matches of a prefix are found by bisection.
+    The local namespace is followed by comparing its keys to the previous
+    update; attribute lists from dir() are cached until the next update.
+    """
+    DIR_CACHE_SIZE = 64 # Number of objects whose attributes are cached.
+
     def __init__ (self, lokals):
         self.locals = lokals
+        self.matches = []
+
+        # Names that stay available whatever happens to the locals
+        self.fixed = set (keyword.kwlist)
+        self.fixed.update (__builtin__.__dict__.keys ())
+        self.fixed.update (__main__.__dict__.keys ())
+
+        self.local_names = set (lokals.keys ())
+        self.names = self.fixed | self.local_names
+        self.completions = sorted (self.names)
+
+        self.dir_cache = collections.OrderedDict ()
 
-        self.completions = keyword.kwlist + \
-                            __builtin__.__dict__.keys() + \
-                            __main__.__dict__.keys()
     def complete (self, text, state):
         if state == 0:
             if "." in text:
@@ -33,49 +56,74 @@ class Completer:
             return None
 
     def update (self, locs):
+        """Follow changes of the local namespace."""
         self.locals = locs
-
-        for key in self.locals.keys ():
-            if not key in self.completions:
-                self.completions.append (key)
+        self.dir_cache.clear ()
+        for key in self.local_names.symmetric_difference (locs):
+            if key in locs:
+                self.local_names.add (key)
+                if not key in self.names:
+                    self.names.add (key)
+                    bisect.insort (self.completions, key)
+            else:
+                self.local_names.discard (key)
+                if not key in self.fixed:
+                    self.names.discard (key)
+                    i = bisect.bisect_left (self.completions, key)
+                    del self.completions[i]
 
     def global_matches (self, text):
-        matches = []
-        n = len (text)
-        for word in self.completions:
-            if word[:n] == text:
-                matches.append (word)
-        return matches
+        return self._prefixed (self.completions, text)
 
     def attr_matches (self, text):
         m = re.match(r"(\w+(\.\w+)*)\.(\w*)", text)
         if not m:
-            return
+            return []
         expr, attr = m.group(1, 3)
 
         obj = eval (expr, self.locals)
-        words = dir(eval(expr, self.locals))
-            
-        matches = []
-        n = len(attr)
-        for word in words:
-            if word[:n] == attr:
-                matches.append ("%s.%s" % (expr, word))
-        return matches
+        words = self._dir (obj)
+        return ["%s.%s" % (expr, word) for word in self._prefixed (words, attr)]
+
+    def _dir (self, obj):
+        """Sorted attribute names of obj, cached per object."""
+        key = id (obj)
+        entry = self.dir_cache.get (key)
+        # Also check the object, its id may have been reused
+        if entry is not None and entry[0] is obj:
+            return entry[1]
+        
+        words = sorted (set (dir (obj)))
+        self.dir_cache[key] = (obj, words)
+        if len (self.dir_cache) > self.DIR_CACHE_SIZE:
+            self.dir_cache.popitem (last=False)
+        return words
+
+    def _prefixed (self, words, text):
+        """Words of the sorted list words starting with text."""
+        start = bisect.bisect_left (words, text)
+        # '\x7f' sorts after all identifier characters
+        end = bisect.bisect_left (words, text + '\x7f', start)
+        while end < len (words) and words[end].startswith (text):
+            end += 1
+        return words[start:end]
 
 class GtkInterpreter (threading.Thread):
     """Run a gtk main() in a separate thread.
     Python commands can be passed to the thread where they will be executed.
-    This is implemented by periodically checking for passed command using a
-    GTK timeout callback.
+    Commands are executed by a worker thread, so a long running command does
+    not block the GTK main loop. Command events and output are passed back
+    to the main loop, where all their handlers run, one after the other.
+    A running command can be stopped with interrupt().
     """
-    TIMEOUT = 100 # Millisecond interval between timeouts.
     
     # Event triggered when a new command is created.
-    command_created = Event()
+    # Handlers get the command and its CommandState.
+    command_created = Event(weak=True, inline=True)
     
     # Event triggered when an existing command has changed.
-    command_updated = Event()
+    # Handlers get the command and its CommandState.
+    command_updated = Event(weak=True, inline=True)
     
     def __init__ (self):
         threading.Thread.__init__ (self)
@@ -84,15 +132,23 @@ class GtkInterpreter (threading.Thread):
         self.locs = locals ()
         self._kill = 0
         self.cmd = None       # Current command block
+        self._scanner = None  # Scanner of the current command block
         self.new_cmds = []  # List of commands not yet added to the command
+        self.running = None   # Command being executed
+        self._interrupted = False
+        self._worker = threading.Thread (target=self._work,
+                                         name='console-worker')
+        self._worker.daemon = True
         
-        self.out = OutputCatcher()
+        self.out = OutputCatcher(dispatch=self._main_loop)
         sys.stdout = self.out
+        self.err = OutputCatcher('<stderr>', dispatch=self._main_loop)
+        sys.stderr = self.err
         
         self.completer = Completer (self.locs)
 
     def run (self):
-        gtk.timeout_add (self.TIMEOUT, self.code_exec)
+        self._worker.start ()
         try:
             if gtk.gtk_version[0] == 2:
                 gtk.threads_init()
@@ -100,80 +156,317 @@ class GtkInterpreter (threading.Thread):
             pass        
         gtk.main ()
 
+    def _work (self):
+        """Worker thread, executes commands as they are fed."""
+        while True:
+            try:
+                if not self.code_exec ():
+                    return
+            except KeyboardInterrupt:
+                pass # Interrupt that arrived after the command finished
+
+    def _main_loop (self, callback, *args):
+        """Call callback with args in the GTK main loop."""
+        def call ():
+            callback (*args)
+            return False
+        gobject.idle_add (call)
+
+    def _notify (self, event, command):
+        """Fire event with command and its current state in the main loop.
+        The worker keeps changing the command, handlers should use the state.
+        """
+        self._main_loop (event, command, command.state ())
+
     def code_exec (self):
-        """Execute waiting command.  Called every timeout period."""
+        """Wait for commands and execute them. Returns false once killed."""
         self.ready.acquire ()
-        if self._kill: gtk.main_quit ()
-        if len(self.new_cmds) > 0:  
-            self.ready.notify ()  
-            
-            if self.cmd:
-                self.cmd += self.new_cmds[0]
-                #self.command_updated(self.cmd)
+        try:
+            while not self.new_cmds and not self._kill:
+                self.ready.wait ()
+            if self._kill:
+                return False
+            cmds = self.new_cmds
+            self.new_cmds = []
+        finally:
+            self.ready.release ()
+        
+        for line in cmds:
+            if isinstance (line, tuple):
+                self._exec_script (*line)
             else:
-                self.cmd = Command(self.new_cmds[0])
-                self.command_created(self.cmd)
-            
-            del self.new_cmds[0]
-            
-            code = None
-            try:
+                self._exec_line (line)
+        return True
+
+    def _exec_line (self, line):
+        """Add a line to the current command block, run it when complete."""
+        if self.cmd:
+            self.cmd += line
+            #self.command_updated(self.cmd)
+        else:
+            self.cmd = Command(line)
+            self._scanner = _BlockScanner ()
+            self._notify (self.command_created, self.cmd)
+        
+        code = None
+        try:
+            # Only compile once the block looks complete
+            if self._scanner.feed (line):
                 code = codeop.compile_command (self.cmd.command[:-1])
-                
-                try:
-                    if code: 
-                        exec (code, self.globs, self.locs)
-                        self.completer.update (self.locs)
-                        
-                        self.cmd.finished = True
-                        self.command_updated(self.cmd)
-                        self.cmd = None
-                    else:
-                        self.cmd.finished = False
-                        self.command_updated(self.cmd)
-                        
-                except Exception as ex:
-                    #traceback.print_exc ()
-                    self.cmd.exec_error = ex
-                    self.command_updated(self.cmd)
-                    self.cmd = None  
             
-            except Exception as ex:
+            try:
+                if code: 
+                    self._exec_code (code, self.cmd)
+                    self.completer.update (self.locs)
+                    
+                    self.cmd.finished = True
+                    self._notify (self.command_updated, self.cmd)
+                    self.cmd = None
+                else:
+                    self.cmd.finished = False
+                    self._notify (self.command_updated, self.cmd)
+                    
+            except (Exception, KeyboardInterrupt) as ex:
                 #traceback.print_exc ()
-                self.cmd.compile_error = ex
-                self.command_updated(self.cmd)
-                self.cmd = None
+                self.cmd.exec_error = ex
+                self._notify (self.command_updated, self.cmd)
+                self.cmd = None  
+        
+        except Exception as ex:
+            #traceback.print_exc ()
+            self.cmd.compile_error = ex
+            self._notify (self.command_updated, self.cmd)
+            self.cmd = None
 
-                
-        self.ready.release()
-        return 1 
+    def _exec_script (self, source, filename):
+        """Compile and run a whole script as a single command."""
+        command = Command(source)
+        self._notify (self.command_created, command)
+        try:
+            code = compile (source, filename, 'exec')
+        except (SyntaxError, TypeError, ValueError) as ex:
+            command.compile_error = ex
+            command.error_line = getattr (ex, 'lineno', None)
+            self._notify (self.command_updated, command)
+            return
+        
+        try:
+            self._exec_code (code, command)
+            self.completer.update (self.locs)
+            command.finished = True
+        except (Exception, KeyboardInterrupt) as ex:
+            command.exec_error = ex
+            # Line of the innermost frame in the script
+            for frame in traceback.extract_tb (sys.exc_info ()[2]):
+                if frame[0] == filename:
+                    command.error_line = frame[1]
+        self._notify (self.command_updated, command)
+
+    def _exec_code (self, code, command):
+        """Execute compiled code, measuring the time taken by command."""
+        wall = time.time ()
+        cpu = _cpu_time ()
+        try:
+            # Inside try, so that _exec_done clears running whatever happens
+            with self.ready:
+                self.running = command
+                self._interrupted = False
+            exec (code, self.globs, self.locs)
+        finally:
+            # An interrupt may still arrive until it is dropped, retry then
+            while True:
+                try:
+                    self._exec_done (command, wall, cpu)
+                    break
+                except KeyboardInterrupt:
+                    pass
+
+    def _exec_done (self, command, wall, cpu):
+        """Finish the execution of command, started at wall and cpu time."""
+        command.wall_time = time.time () - wall
+        command.cpu_time = _cpu_time () - cpu
+        
+        # with releases the lock should the interrupt arrive inside
+        with self.ready:
+            self.running = None
+            if self._interrupted:
+                # Drop the interrupt if it was not raised yet
+                _async_raise (self._worker.ident, None)
+                self._interrupted = False
+        
+        self.out.flush ()
+        self.err.flush ()
             
     def feed (self, code):
         """Feed a line of command to the thread.
-        This function will block until the command checked by the GTK thread.
-        Return true if executed the command.
-        Returns false if deferring execution until complete block available.
+        The line is executed by the worker thread once the command block it
+        belongs to is complete. Returns immediately.
         """
         if (not code) or (code[-1]<>'\n'): code = code +'\n' # raw_input strips newline
-        self.completer.update (self.locs) 
         self.ready.acquire()
         self.new_cmds.append(code)
+        self.ready.notify ()
         self.ready.release ()
+
+    def feed_many (self, source, filename='<paste>'):
+        """Feed a script to the thread, given as a string or a list of lines.
+        The script is compiled once and run as a single command, so errors
+        refer to its line numbers. Returns immediately.
+        """
+        if not isinstance (source, basestring):
+            source = '\n'.join (line.rstrip ('\n') for line in source)
+        if not source.endswith ('\n'):
+            source = source + '\n'
+        self.ready.acquire()
+        self.new_cmds.append((source, filename))
+        self.ready.notify ()
+        self.ready.release ()
+
+    def run_file (self, filename):
+        """Run the Python script filename in the interpreter."""
+        f = open (filename, 'rU')
+        try:
+            source = f.read ()
+        finally:
+            f.close ()
+        self.feed_many (source, filename)
+
+    def interrupt (self):
+        """Raise KeyboardInterrupt in the running command.
+        The exception is raised when the command executes its next Python
+        instruction, so a command blocked in a system call stops once the
+        call returns. Returns false if no command was running.
+        """
+        self.ready.acquire()
+        try:
+            if self.running is None:
+                return False
+            self._interrupted = True
+            _async_raise (self._worker.ident, KeyboardInterrupt)
+            return True
+        finally:
+            self.ready.release()
         
     def kill (self):
         """Kill the thread, returning when it has been shut down."""
         self.ready.acquire()
         self._kill=1
+        self.ready.notify ()
         self.ready.release()
+        self.interrupt ()
+        self._main_loop (gtk.main_quit)
         self.join()
 
+
+class _BlockScanner (object):
+    """Follows the tokenizer state over the lines of a command block, to
+    tell whether the block may be complete without compiling it.
+    A block is open while a bracket, a triple quoted string or a backslash
+    continuation is open. A compound statement is closed by a blank line.
+    """
+    CONTINUATIONS = ('elif', 'else', 'except', 'finally', 'def', 'class')
+    
+    def __init__ (self):
+        self.depth = 0          # Open brackets
+        self.quote = None       # Quote of the open triple quoted string
+        self.continued = False  # Line ended with a backslash
+        self.compound = None    # Is the block a compound statement?
+
+    def feed (self, line):
+        """Scan the next line, return true if the block may be complete."""
+        blank = not line.strip () and not self.quote
+        last = self._scan (line)
+        
+        if self.quote or self.depth > 0 or self.continued:
+            return False
+        if self.compound is None:
+            stripped = line.lstrip ()
+            self.compound = last == ':' or stripped.startswith ('@')
+            return not self.compound
+        # A dedented line ends the block, unless it continues the statement
+        dedent = line[:1] not in ' \t\n' and \
+            not line.split (None, 1)[0].rstrip (':') in self.CONTINUATIONS
+        return blank or dedent or not self.compound
+
+    def _scan (self, line):
+        """Update the state with line, return its last significant char."""
+        last = None
+        self.continued = False
+        i = 0
+        n = len (line)
+        while i < n:
+            c = line[i]
+            if self.quote:
+                if c == '\\':
+                    i += 2
+                    continue
+                if line.startswith (self.quote, i):
+                    i += len (self.quote)
+                    if len (self.quote) == 1:
+                        last = c
+                    self.quote = None
+                    continue
+                if len (self.quote) == 1 and c == '\n':
+                    self.quote = None # Unterminated, let compile tell
+                i += 1
+                continue
+            
+            if c == '#':
+                break
+            elif c in '\'"':
+                if line.startswith (c * 3, i):
+                    self.quote = c * 3
+                    i += 3
+                else:
+                    self.quote = c
+                    i += 1
+                continue
+            elif c in '([{':
+                self.depth += 1
+            elif c in ')]}':
+                self.depth = max (0, self.depth - 1)
+            elif c == '\\' and line[i + 1:].strip () == '':
+                self.continued = True
+                break
+            
+            if not c.isspace ():
+                last = c
+            i += 1
+        return last
+
+
+def _async_raise (thread_id, exception):
+    """Raise exception in the thread with thread_id, or clear the exception
+    that was not raised yet if exception is None.
+    """
+    if exception is not None:
+        exception = ctypes.py_object (exception)
+    ctypes.pythonapi.PyThreadState_SetAsyncExc (ctypes.c_long (thread_id),
+                                                exception)
+
+# RUSAGE_THREAD is only defined by Python 3.2 and later, its value is 1
+_RUSAGE_THREAD = getattr (resource, 'RUSAGE_THREAD',
+                          1 if sys.platform.startswith ('linux') else None)
+
+def _cpu_time ():
+    """CPU time used by the calling thread in seconds, where the system
+    reports it, otherwise by the whole process."""
+    if _RUSAGE_THREAD is not None:
+        try:
+            usage = resource.getrusage (_RUSAGE_THREAD)
+            return usage.ru_utime + usage.ru_stime
+        except (ValueError, resource.error):
+            pass
+    times = os.times ()
+    return times[0] + times[1]
+
 class Command(object):
     """
     Object containing command to run.
     """
     def __init__(self, code):
-        # Code to run
-        self.command = code
+        # Lines of code to run
+        self.lines = [code]
         
         # Has this line been run?
         self.finished = False
@@ -184,15 +477,119 @@ class Command(object):
         # Error that has occurred while running. None if no errors.
         self.exec_error = None
 
+        # Line of the code where the error occurred, if known.
+        self.error_line = None
+
+        # Wall clock and CPU time taken to run, in seconds. None until run.
+        self.wall_time = None
+        self.cpu_time = None
+
+    @property
+    def command(self):
+        """Code to run. Joined on each access, nothing is cached, so that
+        other threads can read it while lines are added."""
+        return ''.join(self.lines)
+
     def __iadd__(self, other):
-        self.command = self.command + other
+        self.lines.append(other)
         return self
+
+    def state(self):
+        """Snapshot of the state of the command."""
+        return CommandState(self)
+
+
+class CommandState(object):
+    """
+    State of a command at the time of an event.
+    """
+    __slots__ = ('line_count', 'finished', 'compile_error', 'exec_error',
+                 'error_line', 'wall_time', 'cpu_time')
+    
+    def __init__(self, command):
+        # Number of lines of the command
+        self.line_count = len(command.lines)
+        self.finished = command.finished
+        self.compile_error = command.compile_error
+        self.exec_error = command.exec_error
+        self.error_line = command.error_line
+        self.wall_time = command.wall_time
+        self.cpu_time = command.cpu_time
     
 
 class OutputCatcher(object):
+    """
+    File-like object collecting the output of the interpreter.
     
-    output_received = Event()        
+    Written data is buffered and passed on by output_received in chunks.
+    A newline flushes the buffer if nothing was flushed for latency seconds;
+    otherwise the buffer is flushed by a timer in the main loop after at
+    most latency seconds, or as soon as it holds max_size characters. A
+    burst of printing therefore fires at most one event per latency period,
+    while a single print shows up right away.
+    """
+    
+    def __init__(self, name='<stdout>', latency=0.05, max_size=8192,
+                 dispatch=None):
+        # Event triggered with the collected output.
+        self.output_received = Event(weak=True, inline=True)
+        
+        self.name = name
+        self.latency = latency
+        self.max_size = max_size
+        # Called with the event and the data to fire it somewhere else
+        self.dispatch = dispatch
+        
+        self._buffer = []
+        self._size = 0
+        self._last_flush = 0
+        self._timer = None
+        self._lock = threading.Lock()
 
     def write(self, data):
-        self.output_received(data)
-    
+        if not data:
+            return
+        
+        # with releases the lock should an interrupt arrive inside
+        with self._lock:
+            self._buffer.append(data)
+            self._size += len(data)
+            
+            flush = self._size >= self.max_size or \
+                ('\n' in data and 
+                 time.time() - self._last_flush >= self.latency)
+            if not flush and self._timer is None:
+                self._timer = gobject.timeout_add(int(self.latency * 1000),
+                                                  self._timeout)
+        
+        if flush:
+            self.flush()
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        """Pass on all buffered output."""
+        with self._lock:
+            data = ''.join(self._buffer)
+            self._buffer = []
+            self._size = 0
+            self._last_flush = time.time()
+            if self._timer is not None:
+                gobject.source_remove(self._timer)
+                self._timer = None
+        
+        if data and self.dispatch:
+            self.dispatch(self.output_received, data)
+        elif data:
+            self.output_received(data)
+
+    def isatty(self):
+        return False
+
+    def _timeout(self):
+        with self._lock:
+            self._timer = None
+        self.flush()
+        return False
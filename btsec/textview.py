@@ -14,9 +14,11 @@ class Terminal(object):
     
     def __init__(self):
         self.command_history = []
+        self.buffer_ops = 0 # Number of changes made to the output buffer
         
         self.interpreter = GtkInterpreter()
         self.interpreter.out.output_received += self.interpreter_out
+        self.interpreter.err.output_received += self.interpreter_err
         self.interpreter.start()
         self.interpreter.command_created += self.command_created
         self.interpreter.command_updated += self.command_updated
@@ -44,6 +46,9 @@ class Terminal(object):
         self.tag_error_trace = self.output_buffer.create_tag("error_trace",
                                                              foreground="#AA0000",
                                                              left_margin=10)
+        self.tag_time = self.output_buffer.create_tag("time",
+                                                      foreground="#888888",
+                                                      left_margin=10)
         self.tag_stdout = self.output_buffer.create_tag("stdout",
                                                         foreground="#000000",
                                                         editable=False,
@@ -61,6 +66,7 @@ class Terminal(object):
         table.attach(self.input, 0, 1, 1, 2, yoptions=gtk.SHRINK)
         self.input.connect("activate", self.entry_activate, None)
         self.input.connect("key-press-event", self._input_key_press_event)
+        self.input.connect("paste-clipboard", self._input_paste)
         
         self._history_index = 0
         
@@ -81,12 +87,16 @@ class Terminal(object):
         end = self.output_buffer.get_end_iter()
         self.output_buffer.insert_with_tags(end, data, self.tag_stdout)
         
-    def command_created(self, command):
+    def interpreter_err(self, data):
+        end = self.output_buffer.get_end_iter()
+        self.output_buffer.insert_with_tags(end, data, self.tag_error_trace)
+        
+    def command_created(self, command, state):
         self.command_history.append(command)
-        self._update_command_text(command)
+        self._update_command_text(command, state)
         
-    def command_updated(self, command):
-        self._update_command_text(command)
+    def command_updated(self, command, state):
+        self._update_command_text(command, state)
 
     def _input_key_press_event(self, widget, event):
         #print(event.keyval)
@@ -96,7 +106,33 @@ class Terminal(object):
         if event.keyval == 65364: # code for down arrow
             self._show_input_history(-1)
             return True
+        if event.keyval == 99 and event.state & gtk.gdk.CONTROL_MASK and \
+                not self.input.get_selection_bounds(): # ctrl-c, nothing selected
+            self.interpreter.interrupt()
+            return True
+        if event.keyval == 111 and event.state & gtk.gdk.CONTROL_MASK: # ctrl-o
+            self.run_file_dialog()
+            return True
         return False
+
+    def _input_paste(self, entry):
+        """Run text of several lines pasted in the input as one script."""
+        text = gtk.clipboard_get().wait_for_text()
+        if text and "\n" in text.strip():
+            entry.stop_emission("paste-clipboard")
+            self.interpreter.feed_many(text)
+
+    def run_file_dialog(self):
+        """Ask for a Python script and run it in the interpreter."""
+        dialog = gtk.FileChooserDialog("Run script", self.window,
+                                       gtk.FILE_CHOOSER_ACTION_OPEN,
+                                       (gtk.STOCK_CANCEL, gtk.RESPONSE_CANCEL,
+                                        gtk.STOCK_OPEN, gtk.RESPONSE_OK))
+        try:
+            if dialog.run() == gtk.RESPONSE_OK:
+                self.interpreter.run_file(dialog.get_filename())
+        finally:
+            dialog.destroy()
             
     def _show_input_history(self, delta):
         self._history_index += delta
@@ -110,46 +146,84 @@ class Terminal(object):
         else:
             self.input.set_text(self.command_history[0 - self._history_index].command)
     
-    def _update_command_text(self, command):
+    def _update_command_text(self, command, state):
         """
-        Make sure the text is shown for the command.
+        Make sure the text is shown for the command in the given state.
         """
         
-        # If marks present, remove all text
-        # Use original start mark to insert text again
-        # If no marks present, start at the end of the buffer
-        # After insertion store end mark
-        
-        start = None
-        if hasattr(command, 'start_mark'):
-            start = self.output_buffer.get_iter_at_mark(command.start_mark)
-            end = self.output_buffer.get_iter_at_mark(command.end_mark)
-            self.output_buffer.delete(start, end)
-            self.output_buffer.delete_mark(command.end_mark)
-            # start and end should be reinitialised now by delete
-        else:
-            start = self.output_buffer.get_end_iter()
-            command.start_mark = self.output_buffer.create_mark(None, start, left_gravity=True)
+        # The text of a command lies between its start and end mark. Lines
+        # added since the last update are appended at the end mark. The
+        # tag of the text only changes with the state of the command. The
+        # time taken and errors are added once, after the code. The amount
+        # of buffer work per update does not depend on the size of the
+        # command.
+        
+        if not hasattr(command, 'start_mark'):
+            end = self.output_buffer.get_end_iter()
+            command.start_mark = self._buffer_op(self.output_buffer.create_mark,
+                                                 None, end, left_gravity=True)
+            command.end_mark = self._buffer_op(self.output_buffer.create_mark,
+                                               None, end, left_gravity=True)
+            command.rendered_lines = 0
+            command.rendered_tag = None
+            command.rendered_error = False
+            command.rendered_time = False
             
         tag = self.tag_code_incomplete
-        if command.finished:
+        if state.finished:
             tag = self.tag_code_complete
-        if command.compile_error or command.exec_error:
+        if state.compile_error or state.exec_error:
             tag = self.tag_code_error
-        self.output_buffer.insert_with_tags(start, command.command, tag)
-        
-        if command.compile_error:
-            self.output_buffer.insert_with_tags(start, 
-                                                "%s: %s\n" % (command.compile_error.__class__.__name__,
-                                                               command.compile_error.message) , 
-                                                self.tag_error_trace)
-        if command.exec_error:
-            self.output_buffer.insert_with_tags(start, 
-                                                "%s: %s\n" % (command.exec_error.__class__.__name__,
-                                                               command.exec_error.message), 
-                                                self.tag_error_trace)
-        
-        command.end_mark = self.output_buffer.create_mark(None, start, left_gravity=True)
+        
+        if tag is not command.rendered_tag and command.rendered_tag is not None:
+            start = self.output_buffer.get_iter_at_mark(command.start_mark)
+            end = self.output_buffer.get_iter_at_mark(command.end_mark)
+            self._buffer_op(self.output_buffer.remove_tag, command.rendered_tag,
+                            start, end)
+            self._buffer_op(self.output_buffer.apply_tag, tag, start, end)
+        command.rendered_tag = tag
+        
+        lines = command.lines[command.rendered_lines:state.line_count]
+        if lines:
+            self._append(command, ''.join(lines), tag)
+            command.rendered_lines += len(lines)
+        
+        if state.wall_time is not None and not command.rendered_time:
+            self._append(command, self._time_text(state), self.tag_time)
+            command.rendered_time = True
+        
+        if not command.rendered_error:
+            if state.compile_error:
+                self._append(command, self._error_text(state, state.compile_error),
+                             self.tag_error_trace)
+                command.rendered_error = True
+            elif state.exec_error:
+                self._append(command, self._error_text(state, state.exec_error),
+                             self.tag_error_trace)
+                command.rendered_error = True
+
+    def _append(self, command, text, tag):
+        """Insert text after the text of command."""
+        end = self.output_buffer.get_iter_at_mark(command.end_mark)
+        self._buffer_op(self.output_buffer.insert_with_tags, end, text, tag)
+        # The insert moves end behind the text
+        self._buffer_op(self.output_buffer.move_mark, command.end_mark, end)
+
+    def _buffer_op(self, operation, *args, **kwargs):
+        """Perform an operation changing the output buffer, counting it."""
+        self.buffer_ops += 1
+        return operation(*args, **kwargs)
+        
+    def _time_text(self, state):
+        return "%.3f s, %.3f s CPU\n" % (state.wall_time or 0,
+                                         state.cpu_time or 0)
+        
+    def _error_text(self, state, error):
+        message = getattr(error, 'msg', None) or error.message
+        if state.error_line:
+            return "%s: %s (line %d)\n" % (error.__class__.__name__, message,
+                                           state.error_line)
+        return "%s: %s\n" % (error.__class__.__name__, message)
         
         
 if __name__ == "__main__":